@@ -29,6 +29,16 @@ class LibraryNotResolvedException(ApiException):
         super().__init__(428, 'Library for user %s still not resolved' % user_id)
 
 
+class InvalidSeedException(ApiException):
+    def __init__(self, seed):
+        super().__init__(400, 'Seed %s must be an integer between 0 and 2**32 - 1' % seed)
+
+
+class InvalidPlaylistParameterException(ApiException):
+    def __init__(self, name, value):
+        super().__init__(400, 'Invalid playlist %s %s' % (name, value))
+
+
 class MusicGraphServerException(ApiException):
     def __init__(self, msg):
         super().__init__(500, msg)
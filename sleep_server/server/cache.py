@@ -1,23 +1,95 @@
 import os
+import re
+import sys
 import argparse
 from datetime import datetime
+from collections import OrderedDict
+import multiprocessing
+from threading import Lock
 from flask_script import Manager
 import numpy as np
+from scipy.spatial import cKDTree
 import pickle
 
-from server import music_graph_helper as mgh, song_helper, app
+from server import music_graph_helper as mgh, song_helper, app, db
 from server.exceptions import *
 
-_cache_types = {'top_song_stats': {'version': 1}, 'cluster_index': {'version': 1}, 'cluster': {'version': 1},
-                'genre_features': {'version': 1}, 'genre_affinity': {'version': 1}, 'scaler': {'version': 1}}
+_cache_types = {'top_song_stats': {'version': 1}, 'cluster_index': {'version': 2}, 'cluster_store': {'version': 1},
+                'genre_features': {'version': 1}, 'genre_affinity': {'version': 1}, 'scaler': {'version': 1},
+                'genre_paths': {'version': 1}, 'genres': {'version': 1}, 'artists_genres': {'version': 2},
+                'genre_graph': {'version': 1}}
 
 
 CacheCommand = Manager(usage='Perform music graph cache operations')
 
 
+class LRUCache:
+    # in process cache of deserialized cache entries with a memory budget, least recently used entries are evicted
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        size = _payload_nbytes(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, f_key):
+        # removes all entries for which f_key(key) is True
+        with self._lock:
+            for key in [k for k in self._entries if f_key(k)]:
+                self._pop(key)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'used_bytes': self.used_bytes, 'max_bytes': self.max_bytes}
+
+    def _pop(self, key):
+        if key in self._entries:
+            _, size = self._entries.pop(key)
+            self.used_bytes -= size
+
+
+_clusters_lru = LRUCache(app.config['CLUSTER_CACHE_MAX_BYTES'])
+_clusters_lru_stamps = {}  # (cache_type, key) -> (mtime_ns, size, sn) of the file that was last loaded
+_clusters_stores = {}  # cluster_type -> (mtime_ns, size, sn, genres index, memory mapped songs)
+
+
+def _payload_nbytes(obj):
+    # approximate memory taken by cache payload, numpy arrays dominate
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, cKDTree):
+        return obj.data.nbytes + obj.indices.nbytes * 2
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(_payload_nbytes(i) for i in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_payload_nbytes(k) + _payload_nbytes(v) for k, v in obj.items())
+    return sys.getsizeof(obj)
+
+
 def _prepare_cache_key(key):
-    # todo: use regexp replace instead of string
-    return key.replace(':','_')
+    return re.sub(r'[^\w\-.]', '_', key)
 
 
 def _load_from_cache(cache_type, key):
@@ -45,8 +117,10 @@ def _save_to_cache(cache_type, key, sn, payload):
     ct['p'] = payload
     ct['sn'] = sn
     path = app.config['USER_STORAGE_URI'] + entry_name
-    with open(path, 'bw') as f:
+    # readers must never see partially written entry
+    with open(path + '.tmp', 'bw') as f:
         pickle.dump(ct, f, protocol=4)
+    os.replace(path + '.tmp', path)
 
 
 def _compute_global_objects():
@@ -60,17 +134,23 @@ def _compute_global_objects():
     mgh.G = glob
     glob.genre_features, glob.genre_sleepiness, glob.genre_wakefulness = \
         mgh.init_compute_genre_features(glob.genres, top_song_features, top_song_genres)
+    glob.genre_dist, glob.genre_pred = mgh.init_compute_genre_paths(glob.G_genre_sim, max(glob.genres) + 1)
 
     return glob
 
 
 def _update_global_cache(glob, sn):
+    _save_to_cache('genres', 'genres', sn, (glob.genres, glob.genres_names))
+    _save_to_cache('artists_genres', 'artists_genres', sn, (glob.artists_genres.offsets, glob.artists_genres.genre_ids))
+    _save_to_cache('genre_graph', 'genres_similarity', sn, mgh.init_adjacency_to_arrays(glob.genres_similarity))
+    _save_to_cache('genre_graph', 'genre_similarity_graph', sn, mgh.init_graph_to_arrays(glob.G_genre_sim))
     _save_to_cache('top_song_stats', 'top_songs_f_min', sn, glob.top_songs_f_min)
     _save_to_cache('top_song_stats', 'top_songs_f_max', sn, glob.top_songs_f_max)
     _save_to_cache('scaler', 'features_scaler', sn, glob.features_scaler)
     _save_to_cache('genre_features', 'genre_features', sn, glob.genre_features)
     _save_to_cache('genre_affinity', 'genre_sleepiness', sn, glob.genre_sleepiness)
     _save_to_cache('genre_affinity', 'genre_wakefulness', sn, glob.genre_wakefulness)
+    _save_to_cache('genre_paths', 'genre_paths', sn, (glob.genre_dist, glob.genre_pred))
 
 
 @CacheCommand.command
@@ -84,53 +164,211 @@ def update_global_cache():
     print('global objects saved with sn=%s' % sn)
 
 
-@CacheCommand.command
-def update_sleep_clusters_cache():
-    """Updates sleep clusters cache"""
+def _save_clusters_store(cluster_type, sn, genre_clusters, fingerprints):
+    # writes songs of all clusters of all genres into single float32 matrix file and an index of row ranges
+    # keyed by genre id, clusters of a genre occupy contiguous rows. fingerprints of genre songs are stored with
+    # global cache sn so store may be refreshed incrementally
+    songs_file = _prepare_cache_key(cluster_type + '_' + sn) + '.cluster_songs'
+    songs_path = app.config['USER_STORAGE_URI'] + songs_file
+    genres = {}
+    n_rows, n_cols = 0, 0
+    with open(songs_path + '.tmp', 'bw') as f:
+        for gid, clusters in genre_clusters:
+            print('saving %s clusters for "%s"' % (cluster_type, mgh.G.genres[gid]))
+            entries = []
+            for cluster_id, size, songs, affinity in clusters:
+                songs = np.ascontiguousarray(songs, dtype=np.float32)
+                f.write(songs.tobytes())
+                entries.append((cluster_id, size, n_rows, n_rows + songs.shape[0], affinity))
+                n_rows += songs.shape[0]
+                n_cols = songs.shape[1]
+            genres[gid] = entries
+    os.replace(songs_path + '.tmp', songs_path)
+    _save_to_cache('cluster_store', cluster_type, sn, {'songs_file': songs_file, 'shape': (n_rows, n_cols),
+                                                       'genres': genres, 'fingerprints': fingerprints,
+                                                       'global_sn': mgh.G.sn})
+    # songs files of previous stores may be still mapped by running processes, unlink is safe
+    for entry_name in os.listdir(app.config['USER_STORAGE_URI']):
+        if entry_name.startswith(cluster_type + '_') and entry_name.endswith('.cluster_songs') and \
+                entry_name != songs_file:
+            os.remove(app.config['USER_STORAGE_URI'] + entry_name)
+    # store songs search index for each genre
+    _, genres, songs = _open_clusters_store(cluster_type)
+    for gid in genres:
+        if genres[gid]:
+            _save_to_cache('cluster_index', cluster_type + '_' + mgh.G.genres[gid], sn,
+                           mgh.init_build_clusters_index(_genre_songs(genres, songs, gid)))
+
+
+def _compute_genre_clusters(f_extract, genre_ids, workers):
+    if workers > 1:
+        # forked workers must not share db connections with this process, each opens its own
+        db.session.remove()
+        db.engine.dispose()
+        # workers use global objects in mgh.G of this process so they must be forked, not spawned
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            yield from pool.imap_unordered(f_extract, genre_ids)
+    else:
+        for gid in genre_ids:
+            yield f_extract(gid)
+
+
+def _changed_genre_ids(cluster_type, genre_ids, fingerprints):
+    # genres which songs changed since clusters store was built, all genres when global cache changed
+    try:
+        store_index, _ = _load_from_cache('cluster_store', cluster_type)
+    except CacheEntryNotExistsException:
+        return genre_ids
+    if store_index.get('global_sn') != mgh.G.sn:
+        return genre_ids
+    stored_fingerprints = store_index.get('fingerprints', {})
+    return [gid for gid in genre_ids if gid not in store_index['genres'] or
+            stored_fingerprints.get(gid) != fingerprints[gid]]
+
+
+def _update_clusters_cache(cluster_type, f_genre_ids, f_extract, workers, incremental):
     mgh.G = global_from_cache()
     sn = str(datetime.utcnow())
-    for gid, sleep_clusters in mgh.init_compute_sleep_clusters():
-        gname = mgh.G.genres[gid]
-        print('saving sleep clusters for "%s"' % gname)
-        _save_to_cache('cluster', 'sleep_' + gname, sn, sleep_clusters)
-    print('global objects saved with sn=%s' % sn)
+    genre_ids = f_genre_ids()
+    fingerprints = {gid: mgh.init_genre_clusters_fingerprint(gid) for gid in genre_ids}
+    changed_ids = _changed_genre_ids(cluster_type, genre_ids, fingerprints) if incremental else genre_ids
+    print('%i of %i genres will be recomputed' % (len(changed_ids), len(genre_ids)))
 
+    def genre_clusters():
+        # copy unchanged genres from current store
+        for gid in set(genre_ids).difference(changed_ids):
+            yield gid, get_genre_clusters(cluster_type, gid)
+        yield from _compute_genre_clusters(f_extract, changed_ids, workers)
 
-@CacheCommand.command
-def update_wakeup_clusters_cache():
+    # store is written by this process only, after all genres are computed
+    _save_clusters_store(cluster_type, sn, genre_clusters(), fingerprints)
+    print('%s clusters saved with sn=%s' % (cluster_type, sn))
+
+
+def _clusters_command(f):
+    f = CacheCommand.option('-i', '--incremental', dest='incremental', action='store_true', default=False,
+                            help='recompute only genres which songs changed')(f)
+    return CacheCommand.option('-w', '--workers', dest='workers', type=int, default=1,
+                               help='number of worker processes')(f)
+
+
+@_clusters_command
+def update_sleep_clusters_cache(workers, incremental):
+    """Updates sleep clusters cache"""
+    _update_clusters_cache('sleep', mgh.init_sleep_clusters_genre_ids, mgh.init_extract_sleep_clusters, workers,
+                           incremental)
+
+
+@_clusters_command
+def update_wakeup_clusters_cache(workers, incremental):
     """Updates wakeup clusters cache"""
-    mgh.G = global_from_cache()
-    sn = str(datetime.utcnow())
-    for gid, wakeup_clusters in mgh.init_compute_wakeup_clusters():
-        gname = mgh.G.genres[gid]
-        print('saving wakeup clusters for "%s"' % gname)
-        _save_to_cache('cluster', 'wakeup_' + gname, sn, wakeup_clusters)
-    print('global objects saved with sn=%s' % sn)
+    _update_clusters_cache('wakeup', mgh.init_wakeup_clusters_genre_ids, mgh.init_extract_wakeup_clusters, workers,
+                           incremental)
 
 
-@CacheCommand.command
-def update_pop_clusters_cache():
+@_clusters_command
+def update_pop_clusters_cache(workers, incremental):
     """Updates popular clusters cache"""
-    mgh.G = global_from_cache()
-    sn = str(datetime.utcnow())
-    for gid, pop_clusters in mgh.init_compute_pop_clusters():
-        gname = mgh.G.genres[gid]
-        print('saving popular clusters for "%s"' % gname)
-        _save_to_cache('cluster', 'pop_' + gname, sn, pop_clusters)
-    print('global objects saved with sn=%s' % sn)
+    _update_clusters_cache('pop', mgh.init_pop_clusters_genre_ids, mgh.init_extract_pop_clusters, workers,
+                           incremental)
+
+
+def _open_clusters_store(cluster_type):
+    # maps songs matrix of clusters store into memory, pages are shared by all processes via os page cache
+    # store is reopened when it gets rebuilt
+    path = app.config['USER_STORAGE_URI'] + cluster_type + '.cluster_store'
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise CacheEntryNotExistsException(cluster_type + '.cluster_store')
+    store = _clusters_stores.get(cluster_type)
+    if store is None or store[:2] != (st.st_mtime_ns, st.st_size):
+        store_index, sn = _load_from_cache('cluster_store', cluster_type)
+        shape = store_index['shape']
+        if shape[0] > 0:
+            songs = np.memmap(app.config['USER_STORAGE_URI'] + store_index['songs_file'], dtype=np.float32, mode='r',
+                              shape=shape)
+        else:
+            songs = np.zeros(shape, dtype=np.float32)  # empty file cannot be mapped
+        store = (st.st_mtime_ns, st.st_size, sn, store_index['genres'], songs)
+        _clusters_stores[cluster_type] = store
+    return store[2:]
+
+
+def _genre_songs(genres, songs, genre_id):
+    entries = genres[genre_id]
+    return songs[entries[0][2]:entries[-1][3]]
+
+
+def _load_from_cache_lru(cache_type, cluster_type, genre_id):
+    # serves cluster entries from memory as long as file on disk has not changed
+    key = cluster_type + '_' + mgh.G.genres[genre_id]
+    path = app.config['USER_STORAGE_URI'] + key + '.' + cache_type
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise CacheEntryNotExistsException(key + cache_type)
+    stamp = _clusters_lru_stamps.get((cache_type, key))
+    # serial number is known only if file was not modified since it was loaded
+    known_sn = stamp[2] if stamp is not None and stamp[:2] == (st.st_mtime_ns, st.st_size) else None
+    payload = _clusters_lru.get((cache_type, cluster_type, genre_id, known_sn))
+    if payload is not None:
+        return payload, known_sn
+    payload, sn = _load_from_cache(cache_type, key)
+    if stamp is not None and stamp[2] != sn:
+        # cache was rebuilt, drop entries with old serial number
+        _clusters_lru.invalidate(lambda k: k[:3] == (cache_type, cluster_type, genre_id))
+    _clusters_lru_stamps[(cache_type, key)] = (st.st_mtime_ns, st.st_size, sn)
+    _clusters_lru.put((cache_type, cluster_type, genre_id, sn), payload)
+    return payload, sn
+
+
+def clusters_cache_stats():
+    return _clusters_lru.stats()
 
 
 def get_genre_clusters(cluster_type, genre_id):
-    gname = mgh.G.genres[genre_id]
-    return _load_from_cache('cluster', cluster_type + '_' + gname)[0]
+    # returns list of clusters (cluster_id, size, songs, affinity), songs are slices of memory mapped store
+    _, genres, songs = _open_clusters_store(cluster_type)
+    if genre_id not in genres:
+        raise CacheEntryNotExistsException('%s clusters for genre %i' % (cluster_type, genre_id))
+    return [[cluster_id, size, songs[start:end], affinity] for cluster_id, size, start, end, affinity
+            in genres[genre_id]]
 
 
-def global_from_cache():
-    glob = mgh.init_songs_db()
+def get_genre_clusters_index(cluster_type, genre_id):
+    # returns songs of all genre clusters and kd-trees keyed by distance features
+    sn, genres, songs = _open_clusters_store(cluster_type)
+    if not genres.get(genre_id):
+        raise CacheEntryNotExistsException('%s clusters for genre %i' % (cluster_type, genre_id))
+    g_songs = _genre_songs(genres, songs, genre_id)
+    try:
+        trees, index_sn = _load_from_cache_lru('cluster_index', cluster_type, genre_id)
+        if index_sn == sn:
+            return g_songs, trees
+    except CacheEntryNotExistsException:
+        pass
+    # index is being rebuilt, build it from store
+    return g_songs, mgh.init_build_clusters_index(g_songs)
+
+
+def global_from_cache(load_graph=True):
+    glob = mgh.Global()
+    (glob.genres, glob.genres_names), _ = _load_from_cache('genres', 'genres')
+    artists_genres, _ = _load_from_cache('artists_genres', 'artists_genres')
+    glob.artists_genres = song_helper.ArtistsGenres(*artists_genres)
+    # genre paths are precomputed so request handlers do not need similarity graph
+    if load_graph:
+        genres_similarity, _ = _load_from_cache('genre_graph', 'genres_similarity')
+        glob.genres_similarity = mgh.init_adjacency_from_arrays(*genres_similarity)
+        genre_similarity_graph, _ = _load_from_cache('genre_graph', 'genre_similarity_graph')
+        glob.G_genre_sim = mgh.init_graph_from_arrays(*genre_similarity_graph)
+    glob.artists_genres_m = mgh.init_artists_genres_incidences(glob.artists_genres, glob.genres)
     glob.top_songs_f_min, _ = _load_from_cache('top_song_stats', 'top_songs_f_min')
     glob.top_songs_f_max, _ = _load_from_cache('top_song_stats', 'top_songs_f_max')
-    glob.features_scaler, _ = _load_from_cache('scaler', 'features_scaler')
+    glob.features_scaler, glob.sn = _load_from_cache('scaler', 'features_scaler')
     glob.genre_features, _ = _load_from_cache('genre_features', 'genre_features')
     glob.genre_sleepiness, _ = _load_from_cache('genre_affinity', 'genre_sleepiness')
     glob.genre_wakefulness, _ = _load_from_cache('genre_affinity', 'genre_wakefulness')
+    (glob.genre_dist, glob.genre_pred), _ = _load_from_cache('genre_paths', 'genre_paths')
     return glob
@@ -8,11 +8,18 @@ class Config(ConfigBase):
     # PTELLTDHNE6QEG42C 20 api calls rate limit
     # 9UGMUXTCZ2WT7WWMJ 20
     # V91CRTEB0IFMAJBMB 120 but they disabled ;>
+    ECHONEST_API_KEY_LIMITS = {'PTELLTDHNE6QEG42C': 20, '9UGMUXTCZ2WT7WWMJ': 20}  # api calls per minute
+    ECHONEST_API_DEFAULT_LIMIT = 20  # api calls per minute for keys not in ECHONEST_API_KEY_LIMITS
+    ECHONEST_API_THROTTLE_BACKOFF = 5  # in seconds, doubled on each consecutive throttle of a key up to a minute
+    ECHONEST_API_MAX_THROTTLES = 20  # throttled responses after which single api call fails
+    ECHONEST_API_MAX_RETRIES = 5  # retries of api call failed with connection or server error
+    ECHONEST_API_RETRY_BACKOFF = 2  # in seconds, doubled on each retry of api call
     TESTING = False
     SQLALCHEMY_DATABASE_URI = 'mysql://dev@localhost/music_graph_dev2'
     SQLALCHEMY_POOL_RECYCLE = 60*5  # in seconds
     DEBUG = True
     USER_STORAGE_URI = '/home/vagrant/user_storage/'
+    CLUSTER_CACHE_MAX_BYTES = 256*1024*1024  # memory budget for genre clusters kept in process
     FLASK_PIKA_PARAMS = {
         'host': 'localhost',  # amqp.server.com
         'username': 'guest',  # convenience param for username
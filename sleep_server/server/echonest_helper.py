@@ -1,8 +1,11 @@
 import pyen
+import requests
 import inspect
 import os
 from functools import wraps
-import queue
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+import time
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
@@ -12,27 +15,122 @@ from server.exceptions import *
 
 
 return_None_on_not_found = False
-_key_queue = queue.Queue()
-for api_key in app.config['ECHONEST_API_KEYS']:
-    _key_queue.put(api_key)
+
+
+class KeyRateLimiter:
+    # token bucket per api key, limits in calls per minute. calls are scheduled on the key with most tokens left and
+    # throttled keys are backed off
+    def __init__(self, limits, throttle_backoff):
+        self.throttle_backoff = throttle_backoff
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.wait_time = 0.0
+        now = time.monotonic()
+        # api key -> [tokens, calls per second, capacity, refilled at, blocked until, consecutive throttles]
+        self._buckets = {api_key: [limit, limit / 60, limit, now, now, 0] for api_key, limit in limits.items()}
+        self._cond = Condition()
+
+    def acquire(self):
+        # returns api key to make a call with, waits until any key has a token
+        started_at = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                api_key, bucket = max(self._buckets.items(), key=lambda b: b[1][0] if b[1][4] <= now else -1)
+                if bucket[4] <= now and bucket[0] >= 1:
+                    bucket[0] -= 1
+                    self.calls += 1
+                    self.wait_time += now - started_at
+                    return api_key
+                self._cond.wait(self._next_token_in(now))
+
+    def release(self, api_key, throttled=False):
+        with self._cond:
+            bucket = self._buckets[api_key]
+            if throttled:
+                # echonest rate limit is per minute so back off up to a minute
+                bucket[5] += 1
+                bucket[0] = 0
+                bucket[4] = time.monotonic() + min(60, self.throttle_backoff * 2 ** (bucket[5] - 1))
+                self.throttles += 1
+            else:
+                bucket[5] = 0
+            self._cond.notify_all()
+
+    def retried(self, backoff):
+        # call failed with transient error and will be repeated after backoff
+        with self._cond:
+            self.retries += 1
+            self.wait_time += backoff
+
+    def stats(self):
+        with self._cond:
+            return {'calls': self.calls, 'throttles': self.throttles, 'retries': self.retries,
+                    'wait_time': self.wait_time,
+                    'tokens': {api_key: bucket[0] for api_key, bucket in self._buckets.items()}}
+
+    def _refill(self, now):
+        for bucket in self._buckets.values():
+            bucket[0] = min(bucket[2], bucket[0] + (now - bucket[3]) * bucket[1])
+            bucket[3] = now
+
+    def _next_token_in(self, now):
+        return min(max(bucket[4] - now, (1 - bucket[0]) / bucket[1], 0.01) for bucket in self._buckets.values())
+
+
+rate_limiter = KeyRateLimiter({api_key: app.config['ECHONEST_API_KEY_LIMITS'].get(
+    api_key, app.config['ECHONEST_API_DEFAULT_LIMIT']) for api_key in app.config['ECHONEST_API_KEYS']},
+    app.config['ECHONEST_API_THROTTLE_BACKOFF'])
+
+
+def _is_transient_error(exc):
+    # connection errors, timeouts, server errors and non json error pages are retried
+    if isinstance(exc, pyen.PyenException):
+        return exc.http_status >= 500
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code >= 500
+    return isinstance(exc, (requests.RequestException, ValueError))
 
 
 def echonestnonehandler(f):
     @wraps(f)
     def _wrap(*args, **kwargs):
-        api_key = _key_queue.get()
-        try:
-            return f(_make_pyen(api_key), *args, **kwargs)
-        except pyen.PyenException as pyen_exc:
-            # code == 5 -> invalid parameter but also means not found
-            if pyen_exc.code == 5:
-                if return_None_on_not_found:
-                    return None
-                else:
-                    raise EchonestApiObjectNotFoundException(pyen_exc.code, pyen_exc.msg)
-            raise
-        finally:
-            _key_queue.put(api_key)
+        throttles = 0
+        retries = 0
+        while True:
+            api_key = rate_limiter.acquire()
+            throttled = False
+            try:
+                return f(_make_pyen(api_key), *args, **kwargs)
+            except pyen.PyenException as pyen_exc:
+                if pyen_exc.http_status == 429 and throttles < app.config['ECHONEST_API_MAX_THROTTLES']:
+                    # rate limit exceeded, try again on the key with most tokens left
+                    app.logger.debug('echonest api key %s throttled' % api_key)
+                    throttles += 1
+                    throttled = True
+                    continue
+                # code == 5 -> invalid parameter but also means not found
+                if pyen_exc.code == 5:
+                    if return_None_on_not_found:
+                        return None
+                    else:
+                        raise EchonestApiObjectNotFoundException(pyen_exc.code, pyen_exc.msg)
+                if not _is_transient_error(pyen_exc) or retries >= app.config['ECHONEST_API_MAX_RETRIES']:
+                    raise
+                exc = pyen_exc
+            except (requests.RequestException, ValueError) as req_exc:
+                if not _is_transient_error(req_exc) or retries >= app.config['ECHONEST_API_MAX_RETRIES']:
+                    raise
+                exc = req_exc
+            finally:
+                rate_limiter.release(api_key, throttled)
+            retries += 1
+            backoff = app.config['ECHONEST_API_RETRY_BACKOFF'] * 2 ** (retries - 1)
+            app.logger.warning('echonest api call failed (%s), retry %i in %.0fs' % (exc, retries, backoff))
+            rate_limiter.retried(backoff)
+            time.sleep(backoff)
     return _wrap
 
 
@@ -41,6 +139,21 @@ def get_artist(pyen, any_id):
     return pyen.get('artist/profile', id=any_id, bucket=['hotttnesss','id:spotify', 'genre'])['artist']
 
 
+def imap_concurrent(f, *iterables):
+    # calls api function f for each set of arguments concurrently, one worker per api key, rate_limiter picks the key.
+    # results are yielded in order of the arguments while remaining requests keep running
+    with ThreadPoolExecutor(max_workers=len(app.config['ECHONEST_API_KEYS'])) as executor:
+        yield from executor.map(f, *iterables)
+
+
+def map_concurrent(f, *iterables):
+    return list(imap_concurrent(f, *iterables))
+
+
+def get_artists(any_ids):
+    return map_concurrent(get_artist, any_ids)
+
+
 @echonestnonehandler
 def get_artists_in_genre(pyen, genre_name, check_top_artists):
     return pyen.get('genre/artists', results=check_top_artists, name=genre_name, bucket=['hotttnesss',
@@ -71,4 +184,7 @@ def get_similar_genres(pyen, genre_name):
 
 
 def _make_pyen(api_key):
-    return pyen.Pyen(api_key)
\ No newline at end of file
+    p = pyen.Pyen(api_key)
+    # throttling is handled by rate_limiter
+    p.auto_throttle = False
+    return p
\ No newline at end of file
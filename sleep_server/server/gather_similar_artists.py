@@ -1,6 +1,5 @@
 import inspect
 import os
-import time
 from sqlalchemy import select as sqlselect, exists as sqlexists, text as sqltext
 
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -22,12 +21,14 @@ def process_rows(user, genres_name, rows, force_update):
             if root_db_a is not None:
                 song_helper.transfer_similar_artists(user, root_db_a, genres_name)
         except Exception as exc:
+            # echonest calls are already retried, artist is skipped
             print(exc)
-            print('will try again')
-            time.sleep(20)
+            print('artist %s skipped' % row[0])
+            db.session.rollback()
         cnt -= 1
         if cnt % 10 == 0:
             print('%i artists left' % cnt)
+    print('echonest api usage %s' % echonest_helper.rate_limiter.stats())
     print('done')
 
 
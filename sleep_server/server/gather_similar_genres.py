@@ -9,11 +9,15 @@ from server import db, song_helper, echonest_helper
 
 def update_similar_genres():
     _, genres_name = song_helper.db_get_genres()
-    for gname, gid in genres_name.items():
+    gnames = list(genres_name)
+    for gname, similar_genres in zip(gnames, echonest_helper.imap_concurrent(echonest_helper.get_similar_genres,
+                                                                              gnames)):
+        gid = genres_name[gname]
         print('updating genre %s' % gname)
-        similar_genres = echonest_helper.get_similar_genres(gname)['genres']
+        similar_genres = similar_genres['genres']
         song_helper.db_update_similar_genres(gid, [(genres_name[i['name']], i['similarity']) for i in similar_genres])
         db.session.commit()
+    print('echonest api usage %s' % echonest_helper.rate_limiter.stats())
 
 
 if __name__ == '__main__':
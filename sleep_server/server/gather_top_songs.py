@@ -1,7 +1,7 @@
 import inspect
+from itertools import repeat
 from operator import itemgetter
 import pickle
-import time
 import os
 from sqlalchemy import select as sqlselect
 
@@ -44,15 +44,9 @@ def gather_genres_and_artists(check_top_artists):
 
     # enumerate genres and gather all artist ids to check, insert artists to db
     check_artists = []
-    for g_name in genres_name:
-        while True:
-            try:
-                artists = echonest_helper.get_artists_in_genre(g_name, check_top_artists)
-                break
-            except Exception as exc:
-                print(exc)
-                print('will try again')
-                time.sleep(20)
+    g_names = list(genres_name)
+    for g_name, artists in zip(g_names, echonest_helper.imap_concurrent(
+            echonest_helper.get_artists_in_genre, g_names, repeat(check_top_artists))):
         print('got %i artists for genre %s' % (len(artists['artists']), g_name))
         for artist in artists['artists']:
             # check if list contains
@@ -98,31 +92,27 @@ def gather_artists_from_db(_):
 def save_top_songs(check_artists, check_top_artist_songs, song_type):
     # get hottest songs from the artists and store them in db
     steps = -1
-    for genre_id, artist_id, echo_id in check_artists:
+    # hottest songs are fetched concurrently while previous artists are written
+    # http://developer.echonest.com/api/v4/song/search?api_key=UFIOCP1DHXIKUMV2H&format=json&results=10&artist_id=AR6F6I21187FB5A3AA&sort=song_hotttnesss-desc&bucket=id:spotify&bucket=audio_summary
+    artists_songs = echonest_helper.imap_concurrent(echonest_helper.get_top_songs_for_artist,
+                                                    [a[2] for a in check_artists], repeat(check_top_artist_songs))
+    for (genre_id, artist_id, echo_id), songs in zip(check_artists, artists_songs):
         # save current artist
         steps += 1
         with open(_CURRENT_ARTIST_FILE, 'w+') as f:
             f.write(str(artist_id))
         print('processing genre id %i, artists left %i' % (genre_id or -1, len(check_artists) - steps))
-        # get hottest songs for an artist (beware duplicate songs - check spotify id)
-        # http://developer.echonest.com/api/v4/song/search?api_key=UFIOCP1DHXIKUMV2H&format=json&results=10&artist_id=AR6F6I21187FB5A3AA&sort=song_hotttnesss-desc&bucket=id:spotify&bucket=audio_summary
-        while True:
-            try:
-                songs = echonest_helper.get_top_songs_for_artist(echo_id, check_top_artist_songs)
-                break
-            except Exception as exc:
-                print(exc)
-                print('will try again')
-                time.sleep(20)
-
+        # beware duplicate songs - check spotify id
         processed_songs = {}
+        known_spotify_ids = song_helper.db_get_known_spotify_track_ids_for_songs(songs['songs'])
         for song in songs['songs']:
-            song_helper.db_update_song(song, artist_id, genre_id, song_type, processed_songs)
+            song_helper.db_update_song(song, artist_id, genre_id, song_type, processed_songs, known_spotify_ids)
 
         # whole artist must be written at once
         db.session.commit()
         print('commited songs')
 
+    print('echonest api usage %s' % echonest_helper.rate_limiter.stats())
     # cleanup
     os.remove(_CURRENT_ARTIST_FILE)
     os.rename(_CHECK_ARTISTS_FILE, '.check_artists_done')
@@ -94,6 +94,16 @@ def _user_lib_resolver_callback(ch, method, properties, body):
     if library.unresolved_tracks:
         _, _, _, new_artists = user_library.resolve_user_library(library, music_graph_helper.G.genres_names)
         user_library.save_library(library)
+        # materialize scaled library features so request handlers do not query them
+        lib_song_features, _ = music_graph_helper.load_user_library_song_features(library)
+        if lib_song_features.shape[0] > 0:
+            lib_song_features, _, _ = music_graph_helper.prepare_songs(lib_song_features,
+                                                                       music_graph_helper.G.features_scaler,
+                                                                       shuffle=False)
+            user_library.save_library_features(library, lib_song_features, music_graph_helper.G.sn)
+            user_library.save_library_genres(library, music_graph_helper.G.sn,
+                                             music_graph_helper.compute_library_genres(lib_song_features,
+                                                                                       library.artists))
         if len(new_artists) > 0:
             song_helper.infer_and_store_genres_for_artists(user, new_artists, music_graph_helper.G.genres_names)
             # todo: trigger refresh of artists genres in graph
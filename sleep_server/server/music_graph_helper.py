@@ -1,14 +1,15 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.csgraph
 import sklearn
 from sklearn import manifold, mixture, cluster
+from scipy.spatial import cKDTree
 import math
 import functools
-import random
+import heapq
 import networkx as nx
 from operator import itemgetter
-from itertools import islice
 
-from common.common import get_first
 from server import app, song_helper
 from server.exceptions import CacheEntryNotExistsException
 
@@ -29,16 +30,20 @@ _blocked_sleep_genres = ['modern performance', 'classical christmas', 'christmas
 _blocked_wakeup_genres = []
 
 _significant_genres = 4  # number of top genres for artist that will be used in user pref computations
+_significant_wakeup_genres = 8  # as above but for wakeup genres
 
 _dist_mod_sleep = [3, 0.3, 1, 0.5, 1, 1, 1, 5]  # distance modifiers when clustering songs (dimensions get weighted)
 _sound_energy_dist = [0, 4, 5, 8]  # distance measure based on energy and soft features: speechiness acousticness etc.
+_energy_similarity = [0, 2, 8]  # distance measure based on energy, tempo and danceability
+_indexed_dists = [_energy_similarity, _sound_energy_dist]  # distance measures with kd-tree in clusters index
 # _dist_mod_library = [3,0.3,1,0.5,2,2,1,3]
 
 
 # global stuff created or loaded from cache
 class Global:
     __slots__ = ['genres', 'genres_names', 'top_songs_f_min', 'top_songs_f_max', 'artists_genres', 'features_scaler',
-                 'genre_features', 'genre_sleepiness', 'genre_wakefulness', 'G_genre_sim', 'genres_similarity']
+                 'genre_features', 'genre_sleepiness', 'genre_wakefulness', 'G_genre_sim', 'genres_similarity', 'sn',
+                 'artists_genres_m', 'genre_dist', 'genre_pred']
 
     def __init__(self):
         self.genres = None
@@ -52,6 +57,10 @@ class Global:
         self.genre_wakefulness = None
         self.G_genre_sim = None
         self.genres_similarity = None
+        self.sn = None  # serial number of global cache
+        self.artists_genres_m = None  # significant_genres -> sparse artist id x genre id incidence matrix
+        self.genre_dist = None  # all pairs shortest path distances in G_genre_sim indexed by genre ids
+        self.genre_pred = None  # predecessors on the shortest paths above
 
 
 G = Global()
@@ -60,6 +69,26 @@ G = Global()
 def load_user_library_song_features(library):
     load_tracks = set([t['song_id'] for t in library.tracks.values() if t['song_id'] is not None])
     rows = song_helper.db_select_song_rows(song_helper.db_make_song_selector_from_list(load_tracks))
+    return _library_song_features(library, rows)
+
+
+def load_users_library_song_features(libraries):
+    # songs of all libraries are selected at once
+    if not libraries:
+        return []
+    load_tracks = set([t['song_id'] for library in libraries for t in library.tracks.values()
+                       if t['song_id'] is not None])
+    rows = np.array(song_helper.db_select_song_rows(song_helper.db_make_song_selector_from_list(load_tracks)),
+                    dtype=np.float32).reshape(-1, 16)
+    rv = []
+    for library in libraries:
+        lib_song_ids = np.fromiter((t['song_id'] for t in library.tracks.values() if t['song_id'] is not None),
+                                   dtype=np.float64)
+        rv.append(_library_song_features(library, rows[np.isin(rows[:, _f_song_id_i], lib_song_ids)]))
+    return rv
+
+
+def _library_song_features(library, rows):
     song_features = np.zeros((len(rows), 21), dtype=np.float32)
     song_features[:, :-5] = rows
     # None maps to NaN, zero it
@@ -86,14 +115,10 @@ def load_user_library_song_features(library):
     return song_features, indexed_tracks
 
 
-def _first_song_idx_with_genre(song_features, gid):
-    idx = -1
-    for np_artist_id in np.nditer(song_features[:, _f_artist_id_i]):
-        artist_id = int(np_artist_id)
-        idx += 1
-        if artist_id in G.artists_genres and gid in G.artists_genres[artist_id]:
-            return idx
-    return idx
+def _first_song_idx_with_genre(with_genre):
+    # with_genre is a mask over songs, last song if none has the genre
+    with_genre_idxs = np.flatnonzero(with_genre)
+    return int(with_genre_idxs[0]) if len(with_genre_idxs) > 0 else len(with_genre) - 1
 
 
 def load_song_features(selector):
@@ -102,20 +127,43 @@ def load_song_features(selector):
     return song_features
 
 
-def prepare_songs(song_features, scaler=None):
-    permutation = np.random.permutation(song_features.shape[0])
-    song_features = song_features[permutation, :]
+def prepare_songs(song_features, scaler=None, rng=None, shuffle=True):
+    # rng is optional np.random.RandomState, global numpy random state is used when not present
+    # without shuffle song_features are scaled in place and returned
+    if shuffle:
+        rng = rng or np.random
+        permutation = rng.permutation(song_features.shape[0])
+        song_features = song_features[permutation, :]
     song_genres = song_features[:, _f_genre_i]
     # normalize features
     normalized_features = song_features[:, :_f_acoustic_i]
     scaler = scaler or sklearn.preprocessing.StandardScaler(copy=False).fit(normalized_features)
-    scaler.transform(normalized_features)
+    _scale_features(normalized_features, scaler)
 
     return song_features, song_genres, scaler
 
 
+def _scale_features(features, scaler):
+    # same as scaler.transform but in place and in dtype of features, transform works in float64
+    if scaler.with_mean:
+        features -= scaler.mean_.astype(features.dtype)
+    if scaler.with_std:
+        features /= scaler.scale_.astype(features.dtype)
+
+
+def prepare_users_songs(users_song_features, scaler):
+    # scales songs of many users stacked in one matrix
+    if not users_song_features:
+        return []
+    stacked = np.concatenate(users_song_features)
+    _scale_features(stacked[:, :_f_acoustic_i], scaler)
+    splits = np.cumsum([song_features.shape[0] for song_features in users_song_features])[:-1]
+    return np.split(stacked, splits)
+
+
+# affinity functions below take a single song or a matrix of songs (one song per row)
 def _f_val_prc(i, f):
-    return (f[i] - G.top_songs_f_min[i]) / (G.top_songs_f_max[i] - G.top_songs_f_min[i])
+    return (f[..., i] - G.top_songs_f_min[i]) / (G.top_songs_f_max[i] - G.top_songs_f_min[i])
 
 
 def _is_sleep_song(features):
@@ -142,19 +190,20 @@ def _wakefulness(features):
     energy = _f_val_prc(0, features)
     danceability = _f_val_prc(8, features)
     valence = _f_val_prc(7, features)
-    return max(energy + valence, danceability + valence)
+    return np.maximum(energy + valence, danceability + valence)
 
 
 def _lib_song_preference(lib_song, time_score_base, time_score_days_base):
     # get a score for source (library is better), be on playlist, be recently listened to and age where
     # you score 1 point for 1-3 days and they it goes down to zero at 20th day
     # 17 - age, 18 - user_preference, 19 no of playlists, 20 source
-    time_score = 0 if lib_song[17] > time_score_days_base*24 else time_score_base \
-        if lib_song[17] < 3*24 else time_score_base*lib_song[17] / (time_score_days_base*24)
-    # print('%i: %f' % (lib_song[17], time_score))
-    source = lib_song[20]
-    source_score = 0.75 if source == 3 else 0.3 if source == 1 else 0
-    return time_score + source_score + lib_song[18] + lib_song[19] * 0.2
+    # takes a single song or a matrix of songs
+    age = lib_song[..., 17].astype(np.float64)
+    time_score = np.where(age > time_score_days_base*24, 0, np.where(
+        age < 3*24, time_score_base, time_score_base*age / (time_score_days_base*24)))
+    source = lib_song[..., 20]
+    source_score = np.where(source == 3, 0.75, np.where(source == 1, 0.3, 0))
+    return time_score + source_score + lib_song[..., 18] + lib_song[..., 19] * 0.2
 
 
 def _lib_song_sleep_preference(lib_song):
@@ -165,33 +214,23 @@ def _lib_song_wake_preference(lib_song):
     return _lib_song_preference(lib_song, 3, 60)
 
 
-def _k_shortest_paths(graph, source, target, k, weight=None):
-    return list(islice(nx.shortest_simple_paths(graph, source, target, weight=weight), k))
-
-
-def _edges_path_iter(graph, path, data=None):
-    for i in range(len(path) - 1):
-        n1 = path[i]
-        n2 = path[i + 1]
-        if data is not None:
-            yield (n1, n2, graph.edge[n1][n2][data])
-        else:
-            yield (n1, n2, graph.edge[n1][n2])
-
+def _genre_path(source, target):
+    # shortest weighted path between genres in similarity graph from precomputed predecessors, None if no path
+    if max(source, target) >= G.genre_dist.shape[0] or not np.isfinite(G.genre_dist[source, target]):
+        return None
+    path = [target]
+    while path[-1] != source:
+        path.append(int(G.genre_pred[source, path[-1]]))
+    return path[::-1]
 
-def _find_closest_genre(graph, gid, possible_genres):
-    shortest_paths = []
-    for possible_gid in possible_genres:
-        try:
-            for path in _k_shortest_paths(graph, gid, possible_gid, 1, weight='weight'):
-                w = functools.reduce(lambda w, edge: w + edge[2], _edges_path_iter(graph, path, data='weight'), 0)
-                shortest_paths.append((path, w))
-        except nx.NetworkXNoPath:
-            pass
 
-    if not shortest_paths:
+def _find_closest_genre(gid, possible_genres):
+    if gid >= G.genre_dist.shape[0]:
+        return None
+    distances = G.genre_dist[gid, possible_genres]
+    if not np.any(np.isfinite(distances)):
         return None
-    return sorted(shortest_paths, key=itemgetter(1))[0][0][-1]
+    return possible_genres[int(np.argmin(distances))]
 
 
 def _euclidean_dist(ref_song, song):
@@ -199,15 +238,32 @@ def _euclidean_dist(ref_song, song):
         lambda y, x: y + (x[0] - x[1]) ** 2, zip(ref_song, song), 0))
 
 
-def find_closest_song(ref_song, songs, distance_features, randlimit=5):
-    # finds closest vector to ref_song among songs using feature indexes 'distance_features', euclidean distance
-    def ec_dist(song):
-        return math.sqrt(functools.reduce(
-            lambda y, x: y + (x[0] - x[1]) ** 2, zip(ref_song[distance_features], song[distance_features]), 0))
+def find_closest_songs(ref_songs, songs, distance_features, randlimit=5, tree=None, rng=None):
+    # finds closest vectors to each of ref_songs among songs using feature indexes 'distance_features', euclidean
+    # distance. for each ref song index of random song among randlimit closest is returned
+    # tree is optional kd-tree built over songs[:, distance_features]
+    rng = rng or np.random
+    ref_vecs = np.asarray(ref_songs)[:, distance_features]
+    if tree is not None:
+        limit = min(randlimit, tree.n)
+        _, closest_idxs = tree.query(ref_vecs, k=limit)
+        closest_idxs = closest_idxs.reshape(len(ref_vecs), limit)
+        return closest_idxs[np.arange(len(ref_vecs)), rng.randint(0, limit, size=len(ref_vecs))]
+    song_vecs = songs[:, distance_features]
+    diffs = ref_vecs[:, np.newaxis, :] - song_vecs[np.newaxis, :, :]
+    distances = np.einsum('ijk,ijk->ij', diffs, diffs)  # squared distance keeps the ordering
+    limit = min(randlimit, distances.shape[1])
+    if limit < distances.shape[1]:
+        closest_idxs = np.argpartition(distances, limit - 1, axis=1)[:, :limit]
+    else:
+        closest_idxs = np.argsort(distances, axis=1)
+    # any of the closest songs is good, order among them does not matter
+    return closest_idxs[np.arange(len(ref_vecs)), rng.randint(0, limit, size=len(ref_vecs))]
+
 
-    distances = np.apply_along_axis(ec_dist, 1, songs)
-    min_dis_idx = np.argsort(distances)[:randlimit][random.randint(0, min(randlimit - 1, len(distances) - 1))]
-    return min_dis_idx
+def find_closest_song(ref_song, songs, distance_features, randlimit=5, rng=None):
+    # finds closest vector to ref_song among songs using feature indexes 'distance_features', euclidean distance
+    return find_closest_songs(ref_song[np.newaxis, :], songs, distance_features, randlimit, rng=rng)[0]
 
 
 def _find_closest_genre_by_acoustics(ref_genre, genre_features, distance_features):
@@ -222,14 +278,11 @@ def _print_features(f_vec):
 def _top_songs_with_affinity(song_features, limit, f_affinity, f_affinity_treshold=None):
     acoustic_features = song_features[:, :_f_acoustic_i]
     if f_affinity_treshold:
-        is_aff_songs = np.apply_along_axis(f_affinity_treshold, 1, acoustic_features)
-        songs_with_affinity = acoustic_features[is_aff_songs]
+        songs_with_affinity = acoustic_features[f_affinity_treshold(acoustic_features)]
         # print(songs_with_affinity.shape)
     else:
         songs_with_affinity = acoustic_features
-    features_affinity = np.zeros(len(songs_with_affinity), dtype=np.float32)
-    for s_id, f in enumerate(songs_with_affinity):
-        features_affinity[s_id] = f_affinity(f)
+    features_affinity = f_affinity(songs_with_affinity).astype(np.float32)
     features_affinity_sorted_idx = np.argsort(features_affinity)
     features_affinity_sorted_idx_rev = features_affinity_sorted_idx[::-1]
     return features_affinity_sorted_idx_rev[:limit]
@@ -239,24 +292,20 @@ def _compute_genres_for_songs(lib_song_features, followed_artists, genres_affini
                               affinity_threshold,
                               genre_prevalence_threshold=0.02, genre_prevalence_count_threshold=10000,
                               significant_genres=_significant_genres):
-    # artists_ids = lib_song_features[:, _f_artist_id_i]
-    genres_accu = []
-    genres_pref = {}
-    for idx in range(lib_song_features.shape[0]):
-        aid = lib_song_features[idx, _f_artist_id_i]
-        # sid = lib_song_features[idx, _f_song_id_i]
-        pref = f_lib_song_preference(lib_song_features[idx])
-        if aid in followed_artists:
-            pref += 0.25
-        if aid in G.artists_genres:
-            gids = G.artists_genres[aid][:significant_genres]
-            genres_accu.extend(gids)
-            for gid in gids:
-                if gid in genres_pref:
-                    genres_pref[gid] += pref
-                else:
-                    genres_pref[gid] = pref
-    genres_count = np.bincount(genres_accu)
+    artist_ids = lib_song_features[:, _f_artist_id_i]
+    prefs = f_lib_song_preference(lib_song_features)
+    if followed_artists:
+        prefs += 0.25 * np.fromiter((aid in followed_artists for aid in artist_ids), dtype=bool,
+                                    count=len(artist_ids))
+    # each song contributes to top significant_genres genres of its artist
+    artists_genres_m = _artists_genres_incidence(significant_genres)
+    has_genres = artist_ids < artists_genres_m.shape[0]
+    songs_genres_m = artists_genres_m[artist_ids[has_genres].astype(np.int64)]
+    genres_count = np.asarray(songs_genres_m.sum(axis=0), dtype=np.int64).ravel()
+    genres_pref = songs_genres_m.T.dot(prefs[has_genres])
+    # same length as bincount over genres of songs
+    nonzero_genres = np.flatnonzero(genres_count)
+    genres_count = genres_count[:nonzero_genres[-1] + 1 if len(nonzero_genres) > 0 else 0]
 
     # lambda f: (_sleepines(f)-min_sleepiness)/(max_sleepiness-min_sleepiness)
     # genre_sleepiness = np.apply_along_axis(_sleepines, 1, genre_features)
@@ -277,80 +326,108 @@ def _compute_genres_for_songs(lib_song_features, followed_artists, genres_affini
     return sorted(top_sleep_genres, key=itemgetter(3), reverse=True)
 
 
-def get_random_song_slice_with_length(song_features, desired_length, add_margin):
-    avg_length = np.mean(song_features[:, _f_duration_id_i])
+def init_artists_genres_incidence(artists_genres, n_genres, significant_genres):
+    # sparse matrix with 1 where genre is one of the top significant_genres genres of artist, rows are artist ids
+    artist_ids, genre_ids = artists_genres.incidence(significant_genres)
+    return scipy.sparse.csr_matrix((np.ones(len(artist_ids)), (artist_ids, genre_ids)),
+                                   shape=(artists_genres.max_artist_id + 1, n_genres))
+
+
+def init_artists_genres_incidences(artists_genres, genres):
+    return {sg: init_artists_genres_incidence(artists_genres, max(genres) + 1, sg)
+            for sg in [_significant_genres, _significant_wakeup_genres]}
+
+
+def _artists_genres_incidence(significant_genres):
+    if significant_genres not in G.artists_genres_m:
+        G.artists_genres_m[significant_genres] = init_artists_genres_incidence(G.artists_genres, max(G.genres) + 1,
+                                                                               significant_genres)
+    return G.artists_genres_m[significant_genres]
+
+
+def _song_id_index(song_features):
+    # song id -> row of first song with that id
+    song_idx = {}
+    for idx, song in enumerate(song_features):
+        song_idx.setdefault(float(song[_f_song_id_i]), idx)
+    return song_idx
+
+
+def get_random_song_slice_with_length(song_features, desired_length, add_margin, rng=None):
+    rng = rng or np.random
+    durations = song_features[:, _f_duration_id_i].astype(np.float64)
+    avg_length = np.mean(durations)
     tot_songs = len(song_features)
-    idx = random.randint(0, tot_songs - int(desired_length/avg_length) - 1)
-    c_len = 0
+    idx = rng.randint(0, tot_songs - int(desired_length/avg_length))
     tot_len = desired_length + int(desired_length*add_margin)
-    songs = []
-    while True:
-        s = song_features[idx]
-        songs.append(s)
-        c_len += s[_f_duration_id_i]
-        if c_len > tot_len:
-            break
-        idx = (idx + 1) % tot_songs
+    # songs from idx, wrapping around as many times as needed to exceed tot_len
+    wraps = int(tot_len // np.sum(durations)) + 2
+    song_idxs = np.arange(idx, idx + wraps * tot_songs) % tot_songs
+    c_lens = np.cumsum(durations[song_idxs])
+    # include song that crosses tot_len
+    n_songs = int(np.searchsorted(c_lens, tot_len, side='right')) + 1
 
-    return songs, c_len
+    return song_features[song_idxs[:n_songs]], c_lens[n_songs - 1]
 
 
 def trim_song_slice_length(track_mappings, song_features, desired_length):
     # trims songs from the right
-    tracks = []
-    c_len = 0
-    for track_id, song_id in track_mappings:
-        song = get_first(song_features, lambda s: s[_f_song_id_i] == song_id)
-        c_len += song[_f_duration_id_i]
-        tracks.append(track_id)
-        if c_len > desired_length:
-            break
-    return tracks, c_len
+    song_idx = _song_id_index(song_features)
+    durations = np.array([song_features[song_idx[song_id]][_f_duration_id_i] for _, song_id in track_mappings],
+                         dtype=np.float64)
+    c_lens = np.cumsum(durations)
+    # include song that crosses desired_length
+    n_tracks = min(int(np.searchsorted(c_lens, desired_length, side='right')) + 1, len(track_mappings))
+    return [track_id for track_id, _ in track_mappings[:n_tracks]], int(c_lens[n_tracks - 1]) if n_tracks > 0 else 0
 
 
 def trim_song_slice_length_by_acoustics(track_mappings, song_features, desired_length, distance_features):
     # trims songs by computing acoustic difference and finding most similar pairs x - o - x
-    c_len = 0
-    # get features of mapped tracks
-    mapped_song_features = []
-    mapped_song_adiffs = []
-    # could not find anything better than this, maybe apply_along_axis..
-    for track_id, song_id in track_mappings:
-        song = get_first(song_features, lambda s: s[_f_song_id_i] == song_id)
-        c_len += song[_f_duration_id_i]
-        mapped_song_features.append(song)
-    # create distances
-    for idx in range(len(mapped_song_features)-2):
+    song_idx = _song_id_index(song_features)
+    mapped_song_features = [song_features[song_idx[song_id]] for _, song_id in track_mappings]
+    durations = [float(song[_f_duration_id_i]) for song in mapped_song_features]
+    c_len = sum(durations)
+    # songs are linked list, n marks the end
+    n = len(mapped_song_features)
+    next_songs = list(range(1, n + 1))
+
+    def song_adiff(idx):
         song = mapped_song_features[idx]
-        ref_song = mapped_song_features[idx+2]
-        mapped_song_adiffs.append(_euclidean_dist(ref_song[distance_features], song[distance_features]))
-    # print('dists %s len %i' % (mapped_song_adiffs, len(mapped_song_adiffs)))
-
-    while True:
-        # remove songs between closest neighbours, +1 to find middle element
-        rem_idx = min(range(len(mapped_song_adiffs)), key=mapped_song_adiffs.__getitem__) + 1
-        rem_len = mapped_song_features[rem_idx][_f_duration_id_i]
-        if c_len - rem_len < desired_length:
+        ref_song = mapped_song_features[next_songs[next_songs[idx]]]
+        return _euclidean_dist(ref_song[distance_features], song[distance_features])
+
+    # distance over the next song kept for each song followed by at least two songs, ordered by (distance, position)
+    # so first closest pair wins. entries with old version are outdated and skipped
+    versions = [0] * n
+    mapped_song_adiffs = [(song_adiff(idx), idx, 0) for idx in range(n - 2)]
+    heapq.heapify(mapped_song_adiffs)
+    while mapped_song_adiffs:
+        _, idx, version = mapped_song_adiffs[0]
+        if version != versions[idx]:
+            heapq.heappop(mapped_song_adiffs)
+            continue
+        # remove songs between closest neighbours
+        rem_idx = next_songs[idx]
+        if c_len - durations[rem_idx] < desired_length:
             break  # stay above desired_length
-        c_len -= rem_len
-        # del removed song
-        del mapped_song_features[rem_idx]
-        del track_mappings[rem_idx]
-        # del from distances
-        if rem_idx < len(mapped_song_adiffs):
-            del mapped_song_adiffs[rem_idx]
-            # update distances
-            song = mapped_song_features[rem_idx-1]
-            ref_song = mapped_song_features[rem_idx+1]
-            mapped_song_adiffs[rem_idx-1] = _euclidean_dist(ref_song[distance_features], song[distance_features])
-        else:
-            del mapped_song_adiffs[rem_idx-1]
-        # print('dists %s len %i' % (mapped_song_adiffs, len(mapped_song_adiffs)))
+        c_len -= durations[rem_idx]
+        next_songs[idx] = next_songs[rem_idx]
+        versions[rem_idx] += 1
+        versions[idx] += 1
+        # update distance over new next song, distance of previous song stays as it was
+        if next_songs[next_songs[idx]] < n:
+            heapq.heappush(mapped_song_adiffs, (song_adiff(idx), idx, versions[idx]))
 
-    return [t[0] for t in track_mappings], int(c_len)
+    tracks = []
+    idx = 0
+    while idx < n:
+        tracks.append(track_mappings[idx][0])
+        idx = next_songs[idx]
+    return tracks, int(c_len)
 
 
 def compute_sleep_genres(library_features, followed_artists, check_songs=100):
+    # returns genres and indexes of library songs genres were computed from
     most_n_indexer = _top_songs_with_affinity(library_features, check_songs, _sleepines)
     most_song_features = library_features[most_n_indexer]
     # print(gr_song_features.shape)
@@ -359,7 +436,7 @@ def compute_sleep_genres(library_features, followed_artists, check_songs=100):
     # most_printable_features = most_song_features[:, :_f_acoustic_i]
     genres = _compute_genres_for_songs(most_song_features, followed_artists, G.genre_sleepiness,
                                        _lib_song_sleep_preference, _is_sleep_genre_threshold)
-    return [g for g in genres if G.genres[g[0]] not in _blocked_sleep_genres], most_song_features
+    return [g for g in genres if G.genres[g[0]] not in _blocked_sleep_genres], most_n_indexer
 
 
 def compute_wakeup_genres(library_features, followed_artists, check_songs=100):
@@ -367,8 +444,8 @@ def compute_wakeup_genres(library_features, followed_artists, check_songs=100):
     most_song_features = library_features[most_n_indexer]
     genres = _compute_genres_for_songs(most_song_features, followed_artists, G.genre_wakefulness,
                                        _lib_song_wake_preference, _is_wakeup_genre_threshold,
-                                       significant_genres=8)
-    return [g for g in genres if G.genres[g[0]] not in _blocked_wakeup_genres], most_song_features
+                                       significant_genres=_significant_wakeup_genres)
+    return [g for g in genres if G.genres[g[0]] not in _blocked_wakeup_genres], most_n_indexer
 
 
 def compute_popular_genres(library_features, followed_artists):
@@ -377,41 +454,38 @@ def compute_popular_genres(library_features, followed_artists):
     genres = _compute_genres_for_songs(library_features, followed_artists, G.genre_sleepiness,
                                        _lib_song_sleep_preference, affinity_threshold=0, genre_prevalence_threshold=gpt,
                                        genre_prevalence_count_threshold=10)
-    return genres, library_features
+    return genres, slice(None)
 
 
-def best_song_idx_with_genre(song_features, gid, min_duration_ms, max_duration_ms, f_affinity_threshold, randlimit):
-    def best_dist(song):
-        artist_id = int(song[_f_artist_id_i])
-        duration_ms = int(song[_f_duration_id_i])
-        if artist_id in G.artists_genres and gid in G.artists_genres[artist_id] and f_affinity_threshold(song) \
-                and max_duration_ms > duration_ms > min_duration_ms:
-            return _lib_song_wake_preference(song)
-        else:
-            return -1
+def compute_library_genres(library_features, followed_artists):
+    # genres of all types for library with indexes of songs they were computed from, depend only on library and G
+    return {'sleep': compute_sleep_genres(library_features, followed_artists),
+            'wakeup': compute_wakeup_genres(library_features, followed_artists),
+            'pop': compute_popular_genres(library_features, followed_artists)}
 
-    # for x in np.nditer(a, flags=['external_loop'], order='F'): but you need to transpose a
-    distances = np.apply_along_axis(best_dist, 1, song_features)
-    # print('best_idx choose among %i' % len(distances[distances>-1]))
-    if np.all(distances == -1):
-        return _first_song_idx_with_genre(song_features, gid)
-    else:
-        # get only != -1
-        sorted_idxs = np.argsort(distances)
-        sorted_idxs = sorted_idxs[distances[sorted_idxs] > -1][::-1][:randlimit]
-        # r_idx = random.randint(0, min(randlimit - 1, len(distances) - 1))
-        # print('choose from %s idx %i' % (sorted_idxs, r_idx))
-        return random.choice(sorted_idxs)
+
+def best_song_idx_with_genre(song_features, gid, min_duration_ms, max_duration_ms, f_affinity_threshold, randlimit,
+                             rng=None):
+    with_genre = G.artists_genres.has_genre(song_features[:, _f_artist_id_i], gid)
+    durations = song_features[:, _f_duration_id_i].astype(np.int64)
+    candidates = np.flatnonzero(with_genre & f_affinity_threshold(song_features) &
+                                (max_duration_ms > durations) & (durations > min_duration_ms))
+    # print('best_idx choose among %i' % len(candidates))
+    if len(candidates) == 0:
+        return _first_song_idx_with_genre(with_genre)
+    # choose randomly among randlimit most preferred
+    preferences = _lib_song_wake_preference(song_features[candidates]).astype(np.float32)
+    best_idxs = candidates[np.argsort(preferences)[::-1][:randlimit]]
+    return best_idxs[(rng or np.random).randint(len(best_idxs))]
 
 
-def find_closest_nodes_subgraph(graph, source, targets):
+def find_closest_nodes_subgraph(source, targets):
+    # targets with the least nodes on the shortest weighted path from source
     distances = []
-    min_len = nx.number_of_nodes(graph) + 1
+    min_len = G.genre_dist.shape[0] + 1
     for t in targets:
-        try:
-            l = len(nx.dijkstra_path(graph, source, t, weight='weight'))
-        except nx.NetworkXNoPath:
-            l = nx.number_of_nodes(graph) + 1
+        path = _genre_path(source, t)
+        l = len(path) if path is not None else G.genre_dist.shape[0] + 1
         if l < min_len:
             min_len = l
         distances.append((t, l))
@@ -420,37 +494,35 @@ def find_closest_nodes_subgraph(graph, source, targets):
 
 
 def generate_wakeup_playlist(wake_gid, lib_wake_song_features, gr_song_features, top_sleep_genres, top_genres,
-                             desired_length, max_song_duration_ms=10*60*1000):
+                             desired_length, max_song_duration_ms=10*60*1000, rng=None):
+    rng = rng or np.random
     wake_song_features = lib_wake_song_features[:, :_f_lib_feats_i]
     # find #start genre song and then #end genre with speechiness, acousticness and instru as close as possible
     # morph energy, temp, dance, valence linearly
     # wake_song_features has wakeful songs filtered for current user
     # find the most wakeful song of given gid
     init_song_idx = best_song_idx_with_genre(lib_wake_song_features, wake_gid, 2 * 60 * 1000, max_song_duration_ms,
-                                             _is_wakeup_song, 5)
+                                             _is_wakeup_song, 5, rng=rng)
     init_song = wake_song_features[init_song_idx]
     # find matchin end genre from sleep genres by speechiness, acousticness and instru
     sound_similarity = [3, 4, 5]
-    energy_similarity = [0, 2, 8]
     possible_sleep_genres = [g[0] for g in top_sleep_genres]
     # genre similarity via graph works much better
-    end_gid = random.choice(find_closest_nodes_subgraph(G.G_genre_sim, wake_gid, possible_sleep_genres))[0]
+    closest_sleep_genres = find_closest_nodes_subgraph(wake_gid, possible_sleep_genres)
+    end_gid = closest_sleep_genres[rng.randint(len(closest_sleep_genres))][0]
     app.logger.debug('going from %s to %s' % (G.genres[end_gid], G.genres[wake_gid]))
     # print('start genre %s' % G.genres[wake_gid])
     # print('end genre %s' % G.genres[end_gid])
     from server import cache
     sleepy_clusters = cache.get_genre_clusters('sleep', end_gid)
-    end_songs = random.choice(sleepy_clusters)[2][:300, :]  # np.vstack(c[2] for c in sleepy_clusters)
-    end_song_idx = find_closest_song(init_song, end_songs, sound_similarity, 1)
+    # np.vstack(c[2] for c in sleepy_clusters)
+    end_songs = sleepy_clusters[rng.randint(len(sleepy_clusters))][2][:300, :]
+    end_song_idx = find_closest_song(init_song, end_songs, sound_similarity, 1, rng=rng)
     end_song = end_songs[end_song_idx]
     # use genre similarity graph to connect wake_gid to end_gid
-    genre_path = []
-    try:
-        for path in _k_shortest_paths(G.G_genre_sim, wake_gid, end_gid, 1, weight='weight'):
-            genre_path = path
-            # print(path)
-    except nx.NetworkXNoPath:
-        raise  # todo: handle NetworkXNoPath somehow
+    genre_path = _genre_path(wake_gid, end_gid)
+    if genre_path is None:
+        raise nx.NetworkXNoPath()  # todo: handle NetworkXNoPath somehow
 
     # part of replace_closest_gid closure
     possible_genres = [g[0] for g in top_genres]
@@ -458,7 +530,7 @@ def generate_wakeup_playlist(wake_gid, lib_wake_song_features, gr_song_features,
     def replace_closest_gid(gid):
         # print(possible_genres)
         if gid not in possible_genres:
-            c_gid = _find_closest_genre(G.G_genre_sim, gid, possible_genres)
+            c_gid = _find_closest_genre(gid, possible_genres)
             if c_gid is not None:
                 # print('----------replaced with %s(%i)' % (G.genres[c_gid], c_gid))
                 return c_gid
@@ -472,64 +544,51 @@ def generate_wakeup_playlist(wake_gid, lib_wake_song_features, gr_song_features,
     expected_steps = round(rem_length / avg_song_len)
     # morph song into end song in expected_steps + 1 steps (+1 -> we need to finish one step before end_song)
     song_diff = (end_song - init_song) / (expected_steps + 1)
-    # var below will be morphed during iteration
-    song_iter = np.copy(init_song)
-    wakeup_playlist = [init_song]
+    # all morphed songs at once, one row per step
+    song_iters = init_song + song_diff * np.arange(1, expected_steps + 1, dtype=np.float32)[:, np.newaxis]
     path_step = len(genre_path) / expected_steps
     # print('expected: %i path_step %f genres %i' % (expected_steps, path_step, len(genre_path)))
+    # group steps by genre clusters so each cluster set is loaded and searched once
+    steps_by_clusters = {}
     for i in range(expected_steps):
-        song_iter += song_diff
         path_idx = int(path_step * i + path_step/2)
         gid = genre_path[path_idx]
         # print('processing %s' % mgh.G.genres[gid])
         # choose afinity func
         if i <= expected_steps // 3:
-            # f_affinity = _wakefulness
-            # f_has_affinity = _is_wakeup_song
             cluster_type = 'wakeup'
-            dist_index = energy_similarity
             gid = replace_closest_gid(gid)
-            # c_songs = gr_song_features[gr_song_genres==gid]
-            # clusters = extract_sleepy_clusters(gid, dist_mod_sleep, f_affinity, f_has_affinity, show_clusters=False)
-            # c_songs = np.vstack(c[2] for c in clusters)
-            # print(len(c_songs))
         elif i <= 2*expected_steps // 3:
-            # f_affinity = lambda x: 1  # identity
-            # f_has_affinity = lambda x: True
             cluster_type = 'pop'
-            dist_index = energy_similarity
             gid = replace_closest_gid(gid)
-            # c_songs = gr_song_features[gr_song_genres==gid]
-            # clusters = extract_sleepy_clusters(gid, dist_mod_sleep, f_affinity, f_has_affinity, show_clusters=False)
-            # c_songs = np.vstack(c[2] for c in clusters)
-            # print(len(c_songs))
         else:
-            # f_affinity = _sleepines
-            # f_has_affinity = _is_sleep_song
             cluster_type = 'sleep'
-            dist_index = _sound_energy_dist
-            # find any song from cluster
-            # clusters = extract_sleepy_clusters(gid, dist_mod_sleep, f_affinity, f_has_affinity, show_clusters=False)
-            # c_songs = np.vstack(c[2] for c in clusters)
+        steps_by_clusters.setdefault((cluster_type, gid), []).append(i)
 
-        # clusters = init_extract_genre_clusters(gid, _dist_mod_sleep, f_affinity, f_has_affinity)
+    step_songs = [None] * expected_steps
+    # fixed order so seeded rng gives same songs
+    for (cluster_type, gid), steps in sorted(steps_by_clusters.items()):
+        dist_index = _sound_energy_dist if cluster_type == 'sleep' else _energy_similarity
         try:
-            clusters = cache.get_genre_clusters(cluster_type, gid)
+            c_songs, c_trees = cache.get_genre_clusters_index(cluster_type, gid)
         except CacheEntryNotExistsException:
-            clusters = cache.get_genre_clusters('pop', gid)
-        c_songs = np.vstack(c[2] for c in clusters)
-        # print(len(c_songs))
+            c_songs, c_trees = cache.get_genre_clusters_index('pop', gid)
         # todo: search many closest songs and order by user preferences then choose -> known songs will pop in!
-        c_song_idx = find_closest_song(song_iter, c_songs, dist_index)
-        # print('%i from %s ----by %s' % (int(c_songs[c_song_idx][15]),
-        #                                 f_affinity.__name__,
-        #                                 song_helper.db_get_artists_name(c_songs[c_song_idx][15])))
-        wakeup_playlist.append(c_songs[c_song_idx])
-    wakeup_playlist.append(end_song)
+        c_song_idxs = find_closest_songs(song_iters[steps], c_songs, dist_index, tree=c_trees[tuple(dist_index)],
+                                         rng=rng)
+        for step, c_song_idx in zip(steps, c_song_idxs):
+            step_songs[step] = c_songs[c_song_idx]
+    wakeup_playlist = [init_song] + step_songs + [end_song]
 
     return wakeup_playlist[::-1]
 
 
+def init_genre_clusters_fingerprint(genre_id, max_duration_ms=10*60*1000, song_limit=5000):
+    # fingerprint of songs that init_extract_genre_clusters will cluster for a genre
+    return song_helper.db_get_genre_songs_fingerprint(genre_id, max_duration_ms, song_limit,
+                                                      significant_genres=_significant_genres)
+
+
 def init_extract_genre_clusters(genre_id, dist_mod, f_affinity, f_has_affinity, max_duration_ms = 10*60*1000,
                                 song_limit=5000, preserve_clusters_size=0.2, min_cluster_affinity_level=0):
     significant_clusters = []
@@ -541,8 +600,7 @@ def init_extract_genre_clusters(genre_id, dist_mod, f_affinity, f_has_affinity,
         return significant_clusters
     song_features, _, _ = prepare_songs(song_features, G.features_scaler)
     # remove songs without affinity (sleepy, wakeful etc)
-    songs_affinity = np.apply_along_axis(f_has_affinity, 1, song_features)
-    song_features = song_features[songs_affinity]
+    song_features = song_features[f_has_affinity(song_features)]
     weighted_features = song_features[:, _clustered_features] * np.asarray(dist_mod)
     # get clusters
     dpgmm = mixture.DPGMM(n_components=12, covariance_type='tied', n_iter=1000, verbose=0)
@@ -561,8 +619,6 @@ def init_extract_genre_clusters(genre_id, dist_mod, f_affinity, f_has_affinity,
     app.logger.debug(significant_clusters)
     # remove outliers
     for cluster in significant_clusters:
-        cluster_songs_affinity = []
-        cluster_songs = []
         cluster_id = cluster[0]
         cluster_features = weighted_features[y_pred == cluster_id]
         all_cluster_features = song_features[y_pred == cluster_id]
@@ -574,18 +630,20 @@ def init_extract_genre_clusters(genre_id, dist_mod, f_affinity, f_has_affinity,
               (novelty_pred[novelty_pred == -1].size * 100.0 / cluster_features.shape[0]))
         novelty_decision = clf.decision_function(cluster_features)[:, 0]
         novelty_decision_sort = np.argsort(novelty_decision)[::-1]
-        for sort_id in novelty_decision_sort:
-            if novelty_pred[sort_id] == 1:
-                song = all_cluster_features[sort_id]
-                cluster_songs_affinity.append(f_affinity(song))
-                cluster_songs.append(song)
-        cluster.append(np.array(cluster_songs))
-        cluster.append(np.mean(cluster_songs_affinity))
+        # inliers ordered by decision function
+        cluster_songs = all_cluster_features[novelty_decision_sort[novelty_pred[novelty_decision_sort] == 1]]
+        cluster.append(cluster_songs)
+        cluster.append(np.mean(f_affinity(cluster_songs)))
     # print(significant_clusters)
     # return cluster list (cluster_id, size, songs, sleepiness)
     return [c for c in significant_clusters if c[3] > min_cluster_affinity_level]  # leave only sleepy clusters
 
 
+def init_build_clusters_index(songs):
+    # builds kd-trees over songs from all genre clusters for distance measures used in playlist generation
+    return {tuple(dist_index): cKDTree(songs[:, dist_index]) for dist_index in _indexed_dists}
+
+
 def init_compute_genre_features(genres, song_features, song_genres):
     # compute genres average acoustic features and level of _sleepines/wakefullness defined as
     # no of song of given type/all songs in genre
@@ -595,11 +653,9 @@ def init_compute_genre_features(genres, song_features, song_genres):
     for genre_id in genres:
         genre_songs = song_features[song_genres == genre_id][:, :_f_duration_id_i+1]
         if genre_songs.shape[0] > 0:
-            genre_songs_sleepiness = np.apply_along_axis(lambda f: 1 if _is_sleep_song(f) else 0, 1, genre_songs)
-            genre_songs_wakefulness = np.apply_along_axis(lambda f: 1 if _is_wakeup_song(f) else 0, 1, genre_songs)
             genre_features[genre_id] = np.mean(genre_songs, axis=0)
-            genre_sleepiness[genre_id] = np.mean(genre_songs_sleepiness)
-            genre_wakefulness[genre_id] = np.mean(genre_songs_wakefulness)
+            genre_sleepiness[genre_id] = np.mean(_is_sleep_song(genre_songs))
+            genre_wakefulness[genre_id] = np.mean(_is_wakeup_song(genre_songs))
 
     return genre_features, genre_sleepiness, genre_wakefulness
 
@@ -691,6 +747,44 @@ def init_compute_genre_similarity_graph(genre_similarity):
     return graph
 
 
+def init_compute_genre_paths(graph, n_genres):
+    # all pairs shortest weighted paths in genre similarity graph, distances and predecessors indexed by genre ids
+    edges = [(n1, n2, data['weight']) for n1, n2, data in graph.edges(data=True)]
+    adjacency = scipy.sparse.csr_matrix(([e[2] for e in edges], ([e[0] for e in edges], [e[1] for e in edges])),
+                                        shape=(n_genres, n_genres))
+    # explicit zero weights are edges in sparse graph
+    distances, predecessors = scipy.sparse.csgraph.shortest_path(adjacency, method='D', directed=False,
+                                                                 return_predecessors=True)
+    return distances.astype(np.float32), predecessors.astype(np.int32)
+
+
+def init_adjacency_to_arrays(adjacency):
+    # {gid: {similar gid: weight}} as edges in parallel arrays
+    edges = [(gid, s_gid, w) for gid, s_genres in adjacency.items() for s_gid, w in s_genres.items()]
+    return np.array([e[0] for e in edges], dtype=np.int32), np.array([e[1] for e in edges], dtype=np.int32), \
+        np.array([e[2] for e in edges], dtype=np.float64)
+
+
+def init_adjacency_from_arrays(gids, s_gids, weights):
+    adjacency = {}
+    for gid, s_gid, w in zip(gids.tolist(), s_gids.tolist(), weights.tolist()):
+        adjacency.setdefault(gid, {})[s_gid] = w
+    return adjacency
+
+
+def init_graph_to_arrays(graph):
+    # undirected graph, each edge once
+    edges = list(graph.edges(data=True))
+    return np.array([e[0] for e in edges], dtype=np.int32), np.array([e[1] for e in edges], dtype=np.int32), \
+        np.array([e[2]['weight'] for e in edges], dtype=np.float64)
+
+
+def init_graph_from_arrays(gids, s_gids, weights):
+    graph = nx.Graph()
+    graph.add_weighted_edges_from(zip(gids.tolist(), s_gids.tolist(), weights.tolist()))
+    return graph
+
+
 def init_connect_genre_graph_components(graph, max_distance, genres, genres_names):
     g_comps = sorted(nx.connected_components(graph), key=len)
     # assume there are few very small disconnected components, connect them back using names ;>
@@ -713,25 +807,35 @@ def init_connect_genre_graph_components(graph, max_distance, genres, genres_name
         # print('-------------')
 
 
-def init_compute_sleep_clusters():
-    for gid, sleepiness_lvl in enumerate(G.genre_sleepiness):
-        if gid in G.genres:
-            gname = G.genres[gid]
-            if gname not in _blocked_sleep_genres and sleepiness_lvl > _is_sleep_genre_threshold:
-                yield gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _sleepines, _is_sleep_song)
+def init_sleep_clusters_genre_ids():
+    return [gid for gid, sleepiness_lvl in enumerate(G.genre_sleepiness) if gid in G.genres and
+            G.genres[gid] not in _blocked_sleep_genres and sleepiness_lvl > _is_sleep_genre_threshold]
+
+
+def init_wakeup_clusters_genre_ids():
+    return [gid for gid, wakefulness_lvl in enumerate(G.genre_wakefulness) if gid in G.genres and
+            G.genres[gid] not in _blocked_wakeup_genres and wakefulness_lvl > _is_wakeup_genre_threshold]
+
+
+def init_pop_clusters_genre_ids():
+    return list(G.genres)
+
+
+# extractors below are module level functions so they can be sent to worker processes
+def init_extract_sleep_clusters(gid):
+    return gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _sleepines, _is_sleep_song)
+
+
+def init_extract_wakeup_clusters(gid):
+    return gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _wakefulness, _is_wakeup_song)
 
 
-def init_compute_wakeup_clusters():
-    for gid, wakefulness_lvl in enumerate(G.genre_wakefulness):
-        if gid in G.genres:
-            gname = G.genres[gid]
-            if gname not in _blocked_wakeup_genres and wakefulness_lvl > _is_wakeup_genre_threshold:
-                yield gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _wakefulness, _is_wakeup_song)
+def _any_song(features):
+    return np.ones(features.shape[:-1], dtype=bool)
 
 
-def init_compute_pop_clusters():
-    for gid in G.genres:
-        yield gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _wakefulness, lambda x: True)#lambda x: 1, lambda x: True)
+def init_extract_pop_clusters(gid):
+    return gid, init_extract_genre_clusters(gid, _dist_mod_sleep, _wakefulness, _any_song)
 
 
 def init_songs_db():
@@ -744,6 +848,7 @@ def init_songs_db():
                                                                                    connected_metric_f=lambda x: sum(x))
     glob.G_genre_sim = init_compute_genre_similarity_graph(glob.genres_similarity)
     init_connect_genre_graph_components(glob.G_genre_sim, max_dist, glob.genres, glob.genres_names)
+    glob.artists_genres_m = init_artists_genres_incidences(glob.artists_genres, glob.genres)
 
     return glob
 
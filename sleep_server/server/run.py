@@ -7,13 +7,33 @@ os.sys.path.insert(0,parentdir)
 from server import app
 from server import server
 
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    uwsgi = None
+
+# uwsgi loads app in master and forks workers unless lazy apps are enabled: load global model once and share it
+# copy-on-write, start mq in each worker
+preload = uwsgi is not None and not uwsgi.opt.get('lazy-apps') and not uwsgi.opt.get('lazy')
+
 # init logging
 server.init_logging()
 # start server
 try:
-    server.start(start_mq=True)
+    server.start(start_mq=not preload, preload=preload)
 except Exception as e:
     app.logger.exception(e)
     raise
+
+if preload:
+    @postfork
+    def start_worker():
+        try:
+            server.start_worker()
+        except Exception as e:
+            app.logger.exception(e)
+            raise
+
 if __name__ == '__main__':
     app.run('localhost', port=5001, debug=app.config['DEBUG'])
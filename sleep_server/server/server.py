@@ -1,8 +1,9 @@
 import inspect
 import os
 import time
-import random
-from flask import json, request
+import gc
+import numpy as np
+from flask import json, request, Response, stream_with_context
 import base64
 from functools import wraps
 import logging
@@ -14,7 +15,8 @@ os.sys.path.insert(0, parentdir)
 from common.user_base import UserBase
 from common import spotify_helper
 from server import app, db, song_helper, echonest_helper, user_library, music_graph_helper as mgh, cache, mq
-from common.exceptions import ApiException, LibraryNotExistsException, LibraryNotResolvedException
+from common.exceptions import ApiException, LibraryNotExistsException, LibraryNotResolvedException, \
+    InvalidSeedException, InvalidPlaylistParameterException
 from common.common import possible_list_types
 
 
@@ -64,21 +66,21 @@ def library_list_playlists(user_id, playlist_type=None):
         raise LibraryNotExistsException(user_id)
     if not library.is_resolved:
         raise LibraryNotResolvedException(user_id)
-    lib_song_features, _ = mgh.load_user_library_song_features(library)
-    lib_song_features, _, _ = mgh.prepare_songs(lib_song_features, mgh.G.features_scaler)
+    lib_song_features, is_materialized = _load_library_song_features(library)
+    library_genres = _load_library_genres(library, lib_song_features, is_materialized)
     add_pl_item = lambda plid, n, card, pref: {'plid': plid, 'name': n, 'card': card, 'pref': pref}
     rv = {}
     for pt in [pt for pt in possible_list_types if playlist_type is None or playlist_type == pt]:
         if pt == 'fall_asleep':
             rv[pt] = []
-            top_sleepys, _ = mgh.compute_sleep_genres(lib_song_features, library.artists)
+            top_sleepys, _ = library_genres['sleep']
             for gid, prevalence, sleepiness, user_pref in top_sleepys:
                 name = 'based on %s with %d%% sleepiness' % (mgh.G.genres[gid], int(sleepiness*100))
                 # print('%s(%i): %f%% affinity:%f pref:%f' % (name, gid, 100*prevalence, 100*sleepiness, user_pref))
                 rv[pt].append(add_pl_item(gid, name, prevalence, user_pref))
         if pt == 'wake_up':
             rv[pt] = []
-            top_wakeful, _ = mgh.compute_wakeup_genres(lib_song_features, library.artists)
+            top_wakeful, _ = library_genres['wakeup']
             for gid, prevalence, wakefulness, user_pref in top_wakeful:
                 name = 'ends on %s with %d%% wakefulness' % (mgh.G.genres[gid], int(wakefulness*100))
                 # print('%s(%i): %f%% affinity:%f pref:%f' % (name, gid, 100*prevalence, 100*wakefulness, user_pref))
@@ -90,55 +92,240 @@ def library_list_playlists(user_id, playlist_type=None):
 @app.route('/library/<user_id>/playlists/<playlist_type>/<int:playlist_id>', methods=['POST', 'PUT'])
 @require_user
 def create_playlist(user, user_id, playlist_type, playlist_id=None):
-    library = user_library.load_library(user_id)
-    if library.is_new:
-        raise LibraryNotExistsException(user_id)
-    if not library.is_resolved:
-        raise LibraryNotResolvedException(user_id)
+    library = _load_resolved_library(user_id)
     # get desired playlist length
     desired_length = int(request.values.get('desired_length'))
+    # same seed and inputs give the same playlist
+    rng = _seeded_rng(request.values.get('seed'))
     # load user library content
-    lib_song_features, _ = mgh.load_user_library_song_features(library)
-    lib_song_features, _, _ = mgh.prepare_songs(lib_song_features, mgh.G.features_scaler)
+    lib_song_features, is_materialized = _load_library_song_features(library)
+    library_genres = _load_library_genres(library, lib_song_features, is_materialized)
+    if playlist_id is None:
+        playlist_id = _choose_playlist_id(playlist_type, library, library_genres, rng)
     pl_tracks, exact_duration = None, None
     if playlist_type == 'fall_asleep':
-        if playlist_id is None:
-            # when playlist id is not present choose genre where user has most preferences
-            top_sleepys, _ = mgh.compute_sleep_genres(lib_song_features, library.artists)
-            # todo: if less than N sleepy clusters just add a few sleepy clusters we like or are close in genre graph
-            playlist_id = user_library.get_best_playlist_id(playlist_type, library, top_sleepys)
         # get genre clusters from cache
         sleep_clusters = cache.get_genre_clusters('sleep', playlist_id)
-        # may have many clusters, select one
-        cluster = sleep_clusters[random.randint(0,len(sleep_clusters)-1)]
-        # get playlist with selected length
-        pl_song_features, _ = mgh.get_random_song_slice_with_length(cluster[2], desired_length, 0.3)
-        # returns list of spotify ids and duration
-        _, _, r_m = song_helper.prepare_playable_tracks(user, [int(f[mgh._f_song_id_i]) for f in
-                                                        pl_song_features])
-        # trim playlist to exact length
-        pl_tracks, exact_duration = mgh.trim_song_slice_length(r_m, pl_song_features, desired_length)
+        pl_tracks, exact_duration = _create_fall_asleep_playlist(user, sleep_clusters, desired_length, rng)
     if playlist_type == 'wake_up':
-        if playlist_id is None:
-            # when playlist id is not present choose genre where user has most preferences
-            top_wakeup, _ = mgh.compute_wakeup_genres(lib_song_features, library.artists)
-            # todo: if less than wakeup clusters use spotify recommend and skip all further logic
-            playlist_id = user_library.get_best_playlist_id(playlist_type, library, top_wakeup)
-        # get most wakeful songs
-        wakeup_genres, wakeup_song_features = mgh.compute_wakeup_genres(lib_song_features, library.artists)
-        sleep_genres, _ = mgh.compute_sleep_genres(lib_song_features, library.artists)
-        pop_genres, _ = mgh.compute_popular_genres(lib_song_features, library.artists)
-        # cut lowest 20% genres, typically crap you not remember
-        pop_genres = pop_genres[:int(-len(pop_genres)*0.2)]
-        wakeup_songs = mgh.generate_wakeup_playlist(playlist_id, wakeup_song_features, lib_song_features,
-                                                    sleep_genres, pop_genres, int(desired_length + 0.5*desired_length))
-        _, _, rm = song_helper.prepare_playable_tracks(user, [int(f[mgh._f_song_id_i]) for f in wakeup_songs])
-        pl_tracks, exact_duration = mgh.trim_song_slice_length_by_acoustics(rm, wakeup_songs, desired_length,
-                                                                            mgh._sound_energy_dist)
+        pl_tracks, exact_duration = _create_wake_up_playlist(user, playlist_id, lib_song_features, library_genres,
+                                                             desired_length, rng)
 
     return json.jsonify(result={playlist_type: {'duration_ms': exact_duration, 'tracks': pl_tracks}})
 
 
+@app.route('/playlists', methods=['POST'])
+def create_playlists():
+    # creates playlists for many users, body is {'items': [{'user': <base64 user as in Authorization header>,
+    # 'playlist_type': ..., 'desired_length': ..., 'playlist_id': optional, 'seed': optional}]}
+    # result or error of each item is streamed as single json line with index of the item
+    items = request.get_json(force=True)['items']
+    return Response(stream_with_context(_create_playlists(items)), mimetype='application/x-ndjson')
+
+
+def _load_resolved_library(user_id):
+    library = user_library.load_library(user_id)
+    if library.is_new:
+        raise LibraryNotExistsException(user_id)
+    if not library.is_resolved:
+        raise LibraryNotResolvedException(user_id)
+    return library
+
+
+def _seeded_rng(seed):
+    # local random state when seed is present, global random state otherwise
+    if seed is None:
+        return None
+    try:
+        # str() rejects floats and booleans passed in json
+        int_seed = int(str(seed))
+    except ValueError:
+        raise InvalidSeedException(seed)
+    if not 0 <= int_seed < 2**32:
+        raise InvalidSeedException(seed)
+    return np.random.RandomState(int_seed)
+
+
+def _playlist_item_params(item):
+    # playlist type and id of batch item are validated as done by routes of single playlist
+    playlist_type = item['playlist_type']
+    if playlist_type not in possible_list_types:
+        raise InvalidPlaylistParameterException('type', playlist_type)
+    playlist_id = item.get('playlist_id')
+    if playlist_id is not None:
+        try:
+            int_id = int(playlist_id)
+        except (TypeError, ValueError):
+            raise InvalidPlaylistParameterException('id', playlist_id)
+        # rejects fractional numbers
+        if int_id != playlist_id and str(int_id) != playlist_id:
+            raise InvalidPlaylistParameterException('id', playlist_id)
+        playlist_id = int_id
+    return playlist_type, playlist_id
+
+
+def _load_library_song_features(library):
+    # use features materialized by library resolver, load from db when missing or outdated
+    lib_song_features = user_library.load_library_features(library, mgh.G.sn)
+    if lib_song_features is None:
+        lib_song_features, _ = mgh.load_user_library_song_features(library)
+        # order of songs is not used
+        lib_song_features, _, _ = mgh.prepare_songs(lib_song_features, mgh.G.features_scaler, shuffle=False)
+        return lib_song_features, _materialize_library_features(library, lib_song_features)
+    return lib_song_features, True
+
+
+def _materialize_library_features(library, lib_song_features):
+    # libraries resolved before features were materialized or before global cache was rebuilt
+    if lib_song_features.shape[0] == 0:
+        return False
+    try:
+        user_library.save_library_features(library, lib_song_features, mgh.G.sn)
+        return True
+    except Exception as e:
+        # features are still used for this request
+        app.logger.exception(e)
+        return False
+
+
+def _load_library_genres(library, lib_song_features, is_materialized):
+    # song indexes in genres refer to rows of features so only genres of materialized features are stored
+    library_genres = user_library.load_library_genres(library, mgh.G.sn) if is_materialized else None
+    if library_genres is None:
+        library_genres = mgh.compute_library_genres(lib_song_features, library.artists)
+        if is_materialized:
+            user_library.save_library_genres(library, mgh.G.sn, library_genres)
+    return library_genres
+
+
+def _choose_playlist_id(playlist_type, library, library_genres, rng=None):
+    # when playlist id is not present choose genre where user has most preferences
+    if playlist_type == 'fall_asleep':
+        top_sleepys, _ = library_genres['sleep']
+        # todo: if less than N sleepy clusters just add a few sleepy clusters we like or are close in genre graph
+        return user_library.get_best_playlist_id(playlist_type, library, top_sleepys, rng=rng)
+    if playlist_type == 'wake_up':
+        top_wakeup, _ = library_genres['wakeup']
+        # todo: if less than wakeup clusters use spotify recommend and skip all further logic
+        return user_library.get_best_playlist_id(playlist_type, library, top_wakeup, rng=rng)
+    return None
+
+
+def _create_fall_asleep_playlist(user, sleep_clusters, desired_length, rng=None):
+    # may have many clusters, select one
+    cluster = sleep_clusters[(rng or np.random).randint(len(sleep_clusters))]
+    # get playlist with selected length
+    pl_song_features, _ = mgh.get_random_song_slice_with_length(cluster[2], desired_length, 0.3, rng=rng)
+    # returns list of spotify ids and duration
+    _, _, r_m = song_helper.prepare_playable_tracks(user, [int(f[mgh._f_song_id_i]) for f in
+                                                    pl_song_features])
+    # trim playlist to exact length
+    return mgh.trim_song_slice_length(r_m, pl_song_features, desired_length)
+
+
+def _create_wake_up_playlist(user, playlist_id, lib_song_features, library_genres, desired_length, rng=None):
+    # get most wakeful songs
+    _, wakeup_song_idxs = library_genres['wakeup']
+    wakeup_song_features = lib_song_features[wakeup_song_idxs]
+    sleep_genres, _ = library_genres['sleep']
+    pop_genres, _ = library_genres['pop']
+    # cut lowest 20% genres, typically crap you not remember
+    pop_genres = pop_genres[:int(-len(pop_genres)*0.2)]
+    wakeup_songs = mgh.generate_wakeup_playlist(playlist_id, wakeup_song_features, lib_song_features,
+                                                sleep_genres, pop_genres, int(desired_length + 0.5*desired_length),
+                                                rng=rng)
+    _, _, rm = song_helper.prepare_playable_tracks(user, [int(f[mgh._f_song_id_i]) for f in wakeup_songs])
+    return mgh.trim_song_slice_length_by_acoustics(rm, wakeup_songs, desired_length, mgh._sound_energy_dist)
+
+
+def _playlist_item_line(item_idx, user_id, playlist_type, pl_tracks, exact_duration):
+    return json.dumps({'item': item_idx, 'user_id': user_id,
+                       'result': {playlist_type: {'duration_ms': exact_duration, 'tracks': pl_tracks}}}) + '\n'
+
+
+def _playlist_item_error_line(item_idx, user_id, e):
+    # same as error handlers but other items are still processed
+    app.logger.exception(e)
+    db.session.rollback()
+    line = _make_error_dict(e, e.status_code if isinstance(e, ApiException) else 500)
+    line.update({'item': item_idx, 'user_id': user_id})
+    return json.dumps(line) + '\n'
+
+
+def _create_playlists(items):
+    # libraries of users are loaded and scaled together, items are grouped by chosen genre so genre clusters
+    # are loaded once per group
+    libraries = {}
+    item_requests = []
+    for item_idx, item in enumerate(items):
+        user_id = None
+        try:
+            user = UserBase.from_jsons(str(base64.decodebytes(item['user'].encode('ascii')), 'ascii'))
+            user_id = user.spotify_id
+            if user_id not in libraries:
+                libraries[user_id] = _load_resolved_library(user_id)
+            playlist_type, playlist_id = _playlist_item_params(item)
+            item_requests.append((item_idx, user, playlist_type, int(item['desired_length']), playlist_id,
+                                  _seeded_rng(item.get('seed'))))
+        except Exception as e:
+            yield _playlist_item_error_line(item_idx, user_id, e)
+
+    lib_song_features = {user_id: user_library.load_library_features(library, mgh.G.sn)
+                         for user_id, library in libraries.items()}
+    # features not materialized are loaded from db for all such users at once
+    load_user_ids = [user_id for user_id, song_features in lib_song_features.items() if song_features is None]
+    failed_user_ids = set()
+    materialized_user_ids = set(user_id for user_id in lib_song_features if user_id not in load_user_ids)
+    try:
+        users_lib_song_features = mgh.prepare_users_songs(
+            [song_features for song_features, _ in
+             mgh.load_users_library_song_features([libraries[user_id] for user_id in load_user_ids])],
+            mgh.G.features_scaler)
+        lib_song_features.update(zip(load_user_ids, users_lib_song_features))
+        materialized_user_ids.update(user_id for user_id in load_user_ids if
+                                     _materialize_library_features(libraries[user_id], lib_song_features[user_id]))
+    except Exception as e:
+        # items of users with materialized features are still processed
+        failed_user_ids.update(load_user_ids)
+        for item_idx, user, *_ in item_requests:
+            if user.spotify_id in failed_user_ids:
+                yield _playlist_item_error_line(item_idx, user.spotify_id, e)
+    libraries_genres = {}
+    genre_requests = {}
+    for item_idx, user, playlist_type, desired_length, playlist_id, rng in item_requests:
+        if user.spotify_id in failed_user_ids:
+            continue
+        try:
+            user_id = user.spotify_id
+            if user_id not in libraries_genres:
+                libraries_genres[user_id] = _load_library_genres(libraries[user_id], lib_song_features[user_id],
+                                                                 user_id in materialized_user_ids)
+            if playlist_id is None:
+                playlist_id = _choose_playlist_id(playlist_type, libraries[user_id], libraries_genres[user_id], rng)
+            genre_requests.setdefault((playlist_type, playlist_id), []).append((item_idx, user, desired_length, rng))
+        except Exception as e:
+            yield _playlist_item_error_line(item_idx, user.spotify_id, e)
+
+    for (playlist_type, playlist_id), g_requests in genre_requests.items():
+        sleep_clusters = None
+        for item_idx, user, desired_length, rng in g_requests:
+            try:
+                pl_tracks, exact_duration = None, None
+                if playlist_type == 'fall_asleep':
+                    if sleep_clusters is None:
+                        sleep_clusters = cache.get_genre_clusters('sleep', playlist_id)
+                    pl_tracks, exact_duration = _create_fall_asleep_playlist(user, sleep_clusters, desired_length,
+                                                                             rng)
+                if playlist_type == 'wake_up':
+                    pl_tracks, exact_duration = _create_wake_up_playlist(user, playlist_id,
+                                                                         lib_song_features[user.spotify_id],
+                                                                         libraries_genres[user.spotify_id],
+                                                                         desired_length, rng)
+                yield _playlist_item_line(item_idx, user.spotify_id, playlist_type, pl_tracks, exact_duration)
+            except Exception as e:
+                yield _playlist_item_error_line(item_idx, user.spotify_id, e)
+
+
 @app.errorhandler(ApiException)
 def handle_api_error(e):
     app.logger.exception(e)
@@ -174,18 +361,51 @@ def init_logging():
     log.addHandler(handler)
 
 
-def start(start_mq=True):
+def _proc_memory_kb(path, field):
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def log_memory_usage(stage):
+    # pages shared copy-on-write with other workers count fully to rss but proportionally to pss
+    app.logger.info('%s: pid %i rss %s kB pss %s kB' % (stage, os.getpid(),
+                                                         _proc_memory_kb('/proc/self/status', 'VmRSS'),
+                                                         _proc_memory_kb('/proc/self/smaps_rollup', 'Pss')))
+
+
+def start(start_mq=True, preload=False):
     spotify_helper.refresh_token_on_expired = True
     spotify_helper.return_None_on_not_found = True
     echonest_helper.return_None_on_not_found = True
 
     app.logger.info('Server runtime starting')
-    mgh.G = cache.global_from_cache()
+    log_memory_usage('global model not loaded')
+    mgh.G = cache.global_from_cache(load_graph=False)
+    if preload and hasattr(gc, 'freeze'):
+        # model is loaded before fork, keep it away from collector so gc does not write to shared pages
+        gc.collect()
+        gc.freeze()
+    log_memory_usage('global model loaded')
     if start_mq:
         app.logger.info('MQ starting')
         mq.start()
 
 
+def start_worker():
+    # called in each worker forked from process where start(start_mq=False, preload=True) was called
+    # threads and db connections do not survive fork
+    db.engine.dispose()
+    log_memory_usage('worker forked')
+    app.logger.info('MQ starting')
+    mq.start()
+
+
 def stop():
     app.logger.info('Server runtime stopping')
     mq.stop()
@@ -1,13 +1,15 @@
 from ordered_set import OrderedSet
-from sqlalchemy import update as sqlupdate, insert as sqlinsert, select as sqlselect, text as sqltext
+from sqlalchemy import update as sqlupdate, insert as sqlinsert, select as sqlselect, text as sqltext, func as sqlfunc
+from sqlalchemy.orm import subqueryload
 from operator import itemgetter
 import math
+import numpy as np
 
 from common.common import *
 from common import spotify_helper
 from server import app, db
 from server.models import Genre, Artist, Song, ArtistGenres, SongTracks, Group, SongGroup, SimilarArtist,\
-    GenreSourceType, SimilarGenre, ArtistAdditionalSpotifyIds
+    GenreSourceType, SimilarGenre, ArtistAdditionalSpotifyIds, Validators
 from server.exceptions import *
 from server import echonest_helper
 
@@ -15,6 +17,11 @@ _song_sel_columns = [Song.AS_energy, Song.AS_liveness, Song.AS_tempo, Song.AS_sp
                      Song.AS_instrumentalness, Song.AS_loudness, Song.AS_valence, Song.AS_danceability, Song.AS_key,
                      Song.AS_mode, Song.AS_time_signature, Song.DurationMs, Song.SongId, Song.GenreId, Song.ArtistId]
 
+# song columns written by upsert when song with EchonestId already exists
+_song_upsert_columns = ['Name', 'Hotness', 'IsToplistSong', 'DurationMs', 'AS_key', 'AS_energy', 'AS_liveness',
+                        'AS_tempo', 'AS_speechiness', 'AS_acousticness', 'AS_instrumentalness', 'AS_mode',
+                        'AS_time_signature', 'AS_loudness', 'AS_valence', 'AS_danceability', 'UpdatedAt']
+
 
 def db_update_artist(pyen_artist, genres_name, additional_spotify_id=None):
     if 'foreign_ids' not in pyen_artist:
@@ -52,11 +59,41 @@ def db_update_artist(pyen_artist, genres_name, additional_spotify_id=None):
     return db_a
 
 
-def db_update_song(pyen_song, db_artist_id, db_genre_id, song_type, processed_songs=None):
+def db_insert_artists(pyen_artists, genres_name):
+    # pyen_artists is a list of (pyen_artist, spotify_id), artists and their genres are written with bulk inserts
+    # returns ids of newly added artists by echonest id
+    if len(pyen_artists) == 0:
+        return {}
+    updated_at = datetime.utcnow()
+    ins_v = []
+    for pyen_artist, artist_sp_id in pyen_artists:
+        ins_v.append({'Name': Validators.max_len_truncate(Artist, 'Name', pyen_artist['name']),
+                      'SpotifyId': artist_sp_id, 'EchonestId': pyen_artist['id'],
+                      'Hotness': pyen_artist['hotttnesss'], 'UpdatedAt': updated_at})
+        app.logger.debug('artist %s NOT found in db, added with %i genres' %
+                         (pyen_artist['name'], len(pyen_artist['genres'])))
+    db.session.execute(sqlinsert(Artist), ins_v)
+    echonest_ids = [pyen_artist['id'] for pyen_artist, _ in pyen_artists]
+    s = sqlselect([Artist.EchonestId, Artist.ArtistId], Artist.EchonestId.in_(echonest_ids))
+    artist_ids = dict(db.session.execute(s).fetchall())
+    ins_v = []
+    for pyen_artist, _ in pyen_artists:
+        for o, n in enumerate(pyen_artist['genres']):
+            ins_v.append({'ArtistId': artist_ids[pyen_artist['id']], 'GenreId': genres_name[n['name']], 'Ord': o,
+                          'SourceType': GenreSourceType.echonest.value})
+    if len(ins_v) > 0:
+        db.session.execute(sqlinsert(ArtistGenres), ins_v)
+
+    return artist_ids
+
+
+def db_update_song(pyen_song, db_artist_id, db_genre_id, song_type, processed_songs=None, known_spotify_ids=None):
+    # known_spotify_ids is a set of track spotify ids already in db (see db_get_known_spotify_track_ids), it gets
+    # updated with tracks added here so songs processed later in the same batch are deduped against them
     processed_songs = processed_songs or {}
     # get all spotify ids
     spotify_ids = [SongTracks(SpotifyId=track['foreign_id'], EchonestId=track['id'])
-                   for track in db_dedup_song_tracks(pyen_song['tracks'])]
+                   for track in db_dedup_song_tracks(pyen_song['tracks'], known_spotify_ids)]
     # check if exists in spotify
     if len(spotify_ids) == 0:
         app.logger.debug('song %s (%s) has no spotifyID or ids got deduped, skipped' % (pyen_song['title'], pyen_song['id']))
@@ -73,6 +110,8 @@ def db_update_song(pyen_song, db_artist_id, db_genre_id, song_type, processed_so
         spotify_ids = [track for track in spotify_ids if track.SpotifyId not in
                        [t.SpotifyId for t in orig_db_s.Tracks]]
         orig_db_s.Tracks += spotify_ids
+        if known_spotify_ids is not None:
+            known_spotify_ids.update(track.SpotifyId for track in spotify_ids)
         app.logger.debug('Song %s (%s) already processed for this artist' % (song_dedup_name, pyen_song['id']))
         return None
 
@@ -82,6 +121,8 @@ def db_update_song(pyen_song, db_artist_id, db_genre_id, song_type, processed_so
         db_s = Song(Tracks=spotify_ids, EchonestId=pyen_song['id'], ArtistId=db_artist_id, GenreId=db_genre_id)
         db.session.add(db_s)
         app.logger.debug('song %s NOT found in db -> added' % pyen_song['title'])
+        if known_spotify_ids is not None:
+            known_spotify_ids.update(track.SpotifyId for track in spotify_ids)
     else:
         app.logger.debug('song %s FOUND in db -> updated' % pyen_song['title'])
     db_s.Name = pyen_song['title']
@@ -107,6 +148,74 @@ def db_update_song(pyen_song, db_artist_id, db_genre_id, song_type, processed_so
     return db_s
 
 
+def _song_upsert_row(pyen_song, db_artist_id, db_genre_id, song_type, updated_at):
+    summary = pyen_song['audio_summary']
+    return {'EchonestId': pyen_song['id'], 'ArtistId': db_artist_id, 'GenreId': db_genre_id,
+            'InsertedAt': updated_at, 'UpdatedAt': updated_at,
+            'Name': Validators.max_len_truncate(Song, 'Name', pyen_song['title']),
+            'Hotness': pyen_song['song_hotttnesss'], 'IsToplistSong': 0 if song_type is None else song_type,
+            'DurationMs': summary['duration']*1000, 'AS_key': summary['key'], 'AS_energy': summary['energy'],
+            'AS_liveness': summary['liveness'], 'AS_tempo': summary['tempo'],
+            'AS_speechiness': summary['speechiness'], 'AS_acousticness': summary['acousticness'],
+            'AS_instrumentalness': summary['instrumentalness'], 'AS_mode': summary['mode'],
+            'AS_time_signature': summary['time_signature'], 'AS_loudness': summary['loudness'],
+            'AS_valence': summary['valence'], 'AS_danceability': summary['danceability']}
+
+
+def _song_upsert_stmt():
+    columns = ['EchonestId', 'ArtistId', 'GenreId', 'InsertedAt'] + _song_upsert_columns
+    stmt = 'INSERT INTO Songs (%s) VALUES (%s)' % (', '.join(columns), ', '.join(':' + c for c in columns))
+    if db.engine.dialect.name == 'mysql':
+        return sqltext(stmt + ' ON DUPLICATE KEY UPDATE ' +
+                       ', '.join('%s=VALUES(%s)' % (c, c) for c in _song_upsert_columns))
+    # sqlite (3.24+) used in benchmarks
+    return sqltext(stmt + ' ON CONFLICT(EchonestId) DO UPDATE SET ' +
+                   ', '.join('%s=excluded.%s' % (c, c) for c in _song_upsert_columns))
+
+
+def db_upsert_songs(pyen_songs, song_type, processed_songs=None, known_spotify_ids=None):
+    # pyen_songs is a list of (pyen_song, db_artist_id, db_genre_id), songs are inserted or updated by EchonestId and
+    # their new tracks attached with bulk statements. processed_songs maps song dedup name to song echonest id and
+    # known_spotify_ids is a set of track spotify ids already in db, both are updated. returns upserted echonest ids
+    processed_songs = {} if processed_songs is None else processed_songs
+    if known_spotify_ids is None:
+        known_spotify_ids = db_get_known_spotify_track_ids_for_songs([song for song, _, _ in pyen_songs])
+    updated_at = datetime.utcnow()
+    song_v = []
+    track_v = []
+    for pyen_song, db_artist_id, db_genre_id in pyen_songs:
+        tracks = db_dedup_song_tracks(pyen_song['tracks'], known_spotify_ids)
+        if len(tracks) == 0:
+            app.logger.debug('song %s (%s) has no spotifyID or ids got deduped, skipped' %
+                             (pyen_song['title'], pyen_song['id']))
+            continue
+        # assert no duplicates in collection
+        assert len(set([track['foreign_id'] for track in tracks])) == len(tracks),\
+            'duplicate spotify id for %s (%s)' % (pyen_song['title'], pyen_song['id'])
+        known_spotify_ids.update(track['foreign_id'] for track in tracks)
+        # remove songs from the same artist with the same name
+        song_dedup_name = normalized_song_dedup_name(db_artist_id, pyen_song['title'])
+        if song_dedup_name in processed_songs:
+            # merge songs' tracks with the same name so no spotify id is lost
+            song_echonest_id = processed_songs[song_dedup_name]
+            app.logger.debug('Song %s (%s) already processed for this artist' % (song_dedup_name, pyen_song['id']))
+        else:
+            song_echonest_id = pyen_song['id']
+            processed_songs[song_dedup_name] = song_echonest_id
+            song_v.append(_song_upsert_row(pyen_song, db_artist_id, db_genre_id, song_type, updated_at))
+        track_v.extend((song_echonest_id, track['foreign_id'], track['id']) for track in tracks)
+    if len(song_v) > 0:
+        db.session.execute(_song_upsert_stmt(), song_v)
+    if len(track_v) > 0:
+        s = sqlselect([Song.EchonestId, Song.SongId], Song.EchonestId.in_(set(t[0] for t in track_v)))
+        song_ids = dict(db.session.execute(s).fetchall())
+        db.session.execute(sqlinsert(SongTracks), [{'SongId': song_ids[song_echonest_id], 'SpotifyId': spotify_id,
+                                                    'EchonestId': echonest_id}
+                                                   for song_echonest_id, spotify_id, echonest_id in track_v])
+
+    return [row['EchonestId'] for row in song_v]
+
+
 def db_get_artist_by_echonest_id(echonest_id):
     return db.session.query(Artist).filter(Artist.EchonestId == echonest_id).one_or_none()
 
@@ -116,6 +225,28 @@ def db_get_artist_by_spotify_id(spotify_id):
            db.session.query(ArtistAdditionalSpotifyIds).filter(ArtistAdditionalSpotifyIds.SpotifyId == spotify_id).one_or_none()
 
 
+def db_get_artists_by_echonest_ids(echonest_ids):
+    # artists with genres loaded by echonest id
+    if len(echonest_ids) == 0:
+        return {}
+    db_artists = db.session.query(Artist).options(subqueryload(Artist.Genres))\
+        .filter(Artist.EchonestId.in_(echonest_ids)).all()
+    return {db_a.EchonestId: db_a for db_a in db_artists}
+
+
+def db_get_artists_by_spotify_ids(spotify_ids):
+    # artists by spotify id, additional spotify ids are also resolved
+    if len(spotify_ids) == 0:
+        return {}
+    db_artists = {db_a.SpotifyId: db_a for db_a in
+                  db.session.query(Artist).filter(Artist.SpotifyId.in_(spotify_ids))}
+    for additional_spotify_id, db_a in db.session.query(ArtistAdditionalSpotifyIds.SpotifyId, Artist)\
+            .join(Artist, Artist.ArtistId == ArtistAdditionalSpotifyIds.ArtistId)\
+            .filter(ArtistAdditionalSpotifyIds.SpotifyId.in_(spotify_ids)):
+        db_artists.setdefault(additional_spotify_id, db_a)
+    return db_artists
+
+
 def db_get_songs_by_spotify_ids(spotify_ids):
     return db.session.query(Song).join(Song.Tracks).filter(SongTracks.SpotifyId.in_(spotify_ids)).all()
 
@@ -134,12 +265,23 @@ def db_get_genres():
     return genres_id, genres_name
 
 
-def db_dedup_song_tracks(tracks):
-    dedup = []
-    for track in tracks:
-        if db.session.query(SongTracks).filter(SongTracks.SpotifyId == track['foreign_id']).one_or_none() is None:
-            dedup.append(track)
-    return dedup
+def db_get_known_spotify_track_ids(spotify_ids):
+    # set of spotify ids already stored as song tracks, single IN query
+    if len(spotify_ids) == 0:
+        return set()
+    s = sqlselect([SongTracks.SpotifyId], SongTracks.SpotifyId.in_(set(spotify_ids)))
+    return set(row[0] for row in db.session.execute(s))
+
+
+def db_get_known_spotify_track_ids_for_songs(pyen_songs):
+    # resolves tracks of all echonest songs in a batch at once
+    return db_get_known_spotify_track_ids([track['foreign_id'] for song in pyen_songs for track in song['tracks']])
+
+
+def db_dedup_song_tracks(tracks, known_spotify_ids=None):
+    if known_spotify_ids is None:
+        known_spotify_ids = db_get_known_spotify_track_ids([track['foreign_id'] for track in tracks])
+    return [track for track in tracks if track['foreign_id'] not in known_spotify_ids]
 
 
 def db_create_song_group(group_name, group_uniq_ref, group_type, overwrite=False):
@@ -199,18 +341,100 @@ def db_get_spotify_track_ids_for_songs(song_ids):
     return indexed_songs
 
 
+class ArtistsGenres:
+    # genres of all artists in flat arrays indexed by artist id: genres of artist_id are
+    # genre_ids[offsets[artist_id]:offsets[artist_id + 1]] in order of significance. read only mapping
+    # artist_id -> list of genre ids with vectorized queries on arrays of artist ids
+    __slots__ = ['offsets', 'genre_ids']
+
+    def __init__(self, offsets, genre_ids):
+        self.offsets = offsets
+        self.genre_ids = genre_ids
+
+    @staticmethod
+    def from_rows(rows):
+        # rows are (GenreId, ArtistId) ordered by ArtistId and significance of genre
+        artist_ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        genre_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        n_artists = int(artist_ids[-1]) + 1 if len(rows) > 0 else 0
+        offsets = np.zeros(n_artists + 1, dtype=np.int32)
+        np.cumsum(np.bincount(artist_ids, minlength=n_artists), out=offsets[1:])
+        g_dtype = np.int16 if len(rows) == 0 or genre_ids.max() <= np.iinfo(np.int16).max else np.int32
+        return ArtistsGenres(offsets, genre_ids.astype(g_dtype))
+
+    @property
+    def max_artist_id(self):
+        return len(self.offsets) - 2
+
+    def _genres_count(self, artist_ids):
+        artist_ids = np.asarray(artist_ids).astype(np.int64)
+        valid = (artist_ids >= 0) & (artist_ids <= self.max_artist_id)
+        starts = np.zeros(artist_ids.shape, dtype=np.int64)
+        counts = np.zeros(artist_ids.shape, dtype=np.int64)
+        starts[valid] = self.offsets[artist_ids[valid]]
+        counts[valid] = self.offsets[artist_ids[valid] + 1] - starts[valid]
+        return starts, counts
+
+    def has_genre(self, artist_ids, gid, first_k=None):
+        # for each artist in artist_ids (may be floats from feature rows) tells if gid is among its first_k genres
+        starts, counts = self._genres_count(artist_ids)
+        if first_k is not None:
+            counts = np.minimum(counts, first_k)
+        starts, counts = starts.ravel(), counts.ravel()
+        # positions of all queried genres in genre_ids and the artist each belongs to
+        owners = np.repeat(np.arange(len(counts)), counts)
+        positions = np.arange(len(owners)) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        found = np.zeros(len(counts), dtype=bool)
+        found[owners[self.genre_ids[positions] == gid]] = True
+        return found.reshape(np.shape(artist_ids))
+
+    def incidence(self, first_k=None):
+        # (artist id, genre id) pairs of first_k genres of all artists
+        artist_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        genre_ids = self.genre_ids.astype(np.int64)
+        if first_k is not None:
+            significant = np.arange(len(genre_ids)) - self.offsets[artist_ids] < first_k
+            artist_ids, genre_ids = artist_ids[significant], genre_ids[significant]
+        return artist_ids, genre_ids
+
+    def __contains__(self, artist_id):
+        _, counts = self._genres_count(artist_id)
+        return bool(counts > 0)
+
+    def __getitem__(self, artist_id):
+        start, count = self._genres_count(artist_id)
+        if count == 0:
+            raise KeyError(artist_id)
+        return self.genre_ids[int(start):int(start + count)].tolist()
+
+    def get(self, artist_id, default=None):
+        return self[artist_id] if artist_id in self else default
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self.offsets)))
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self.offsets)).tolist())
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        offsets = self.offsets.tolist()
+        genre_ids = self.genre_ids.tolist()
+        for artist_id in self:
+            yield artist_id, genre_ids[offsets[artist_id]:offsets[artist_id + 1]]
+
+    def values(self):
+        return (genres for _, genres in self.items())
+
+
 def db_get_all_artists_genres(genre_source_types=None):
     genre_source_types = genre_source_types or [GenreSourceType.echonest.value]
     s = sqlselect([ArtistGenres.GenreId, ArtistGenres.ArtistId], ArtistGenres.SourceType.in_(genre_source_types))\
         .order_by(ArtistGenres.ArtistId).order_by(ArtistGenres.Ord)
     rows = db.session.execute(s).fetchall()
-    a_genres = {}
-    for row in rows:
-        if row[1] not in a_genres:
-            a_genres[row[1]] = [row[0]]
-        else:
-            a_genres[row[1]].append(row[0])
-    return a_genres
+    return ArtistsGenres.from_rows(rows)
 
 
 def db_get_genres_for_artists(artist_ids, genre_source_types=None):
@@ -268,16 +492,27 @@ def db_make_song_selector_from_list(song_ids):
     return sqlselect(_song_sel_columns, Song.SongId.in_(song_ids))
 
 
-def db_make_song_selector_for_genre(genre_id, max_duration_ms, limit, genre_source_types=None, significant_genres=4):
+def db_make_song_selector_for_genre(genre_id, max_duration_ms, limit, genre_source_types=None, significant_genres=4,
+                                    columns=None):
     # todo: write this SQL in alchemy (which is ridiculous)
     gst = genre_source_types or ['1', '2'] #  GenreSourceType.echonest.value, GenreSourceType.infered.value
     song_in_genre_q = " Songs.DurationMs < %i AND EXISTS (SELECT 1 FROM Artists a JOIN ArtistGenres ag ON a.ArtistId "\
                   "= ag.ArtistId WHERE a.ArtistId = Songs.ArtistId AND ag.GenreId = %i AND ag.Ord < %i AND ag.SourceType IN (%s) )"
-    return sqlselect(_song_sel_columns)\
+    return sqlselect(columns or _song_sel_columns)\
         .where(sqltext(song_in_genre_q % (max_duration_ms, genre_id, significant_genres, ','.join(gst))))\
         .order_by(Song.Hotness.desc()).limit(limit)
 
 
+def db_get_genre_songs_fingerprint(genre_id, max_duration_ms, limit, genre_source_types=None, significant_genres=4):
+    # count, newest update and sum of ids of songs selected for genre. changes when songs are added or updated or
+    # when artist genres change
+    songs = db_make_song_selector_for_genre(genre_id, max_duration_ms, limit, genre_source_types=genre_source_types,
+                                            significant_genres=significant_genres,
+                                            columns=[Song.SongId, Song.UpdatedAt]).alias('genre_songs')
+    s = sqlselect([sqlfunc.count(), sqlfunc.max(songs.c.UpdatedAt), sqlfunc.sum(songs.c.SongId)])
+    return tuple(db.session.execute(s).fetchone())
+
+
 def db_make_song_selector_top_songs():
     return sqlselect(_song_sel_columns, Song.IsToplistSong == 1)
 
@@ -287,6 +522,61 @@ def db_select_song_rows(selector):
     return db.session.execute(selector).fetchall()
 
 
+def transfer_songs_artists(pyen_songs, track_mappings, genres_name):
+    # resolves artists of all songs at once: known artists are loaded with one query, unknown artists are fetched
+    # from echonest concurrently and inserted together. returns artists by echonest id and list of new artists
+    echonest_ids = list(OrderedSet(song['artist_id'] for song in pyen_songs))
+    db_artists = db_get_artists_by_echonest_ids(echonest_ids)
+    unknown_ids = [artist_id for artist_id in echonest_ids if artist_id not in db_artists]
+    artists = echonest_helper.get_artists(unknown_ids)
+    # if artist has no foreign id try to get spotify artist id from mappings
+    additional_spotify_ids = {}
+    for artist_id, artist in zip(unknown_ids, artists):
+        if 'foreign_ids' not in artist:
+            song_foreign_ids = set(t['foreign_id'] for song in pyen_songs if song['artist_id'] == artist_id
+                                   for t in song['tracks'] if 'foreign_id' in t)
+            mapping = get_first(track_mappings, lambda m: m[0] in song_foreign_ids)
+            if mapping is not None:
+                additional_spotify_ids[artist_id] = mapping[1]
+    # get artists by spotify id
+    sp_artists = db_get_artists_by_spotify_ids(list(set(additional_spotify_ids.values())))
+    insert_artists = []
+    inserted_sp_ids = {}
+    for artist_id, artist in zip(unknown_ids, artists):
+        additional_spotify_id = additional_spotify_ids.get(artist_id)
+        if additional_spotify_id in sp_artists:
+            db_artists[artist_id] = sp_artists[additional_spotify_id]
+            continue
+        if 'foreign_ids' in artist:
+            artist_sp_id = artist['foreign_ids'][0]['foreign_id']
+        elif additional_spotify_id is not None:
+            # it often happens that spotify id is resolved but then not included in echonest artist
+            artist_sp_id = additional_spotify_id
+        else:
+            app.logger.debug('artist %s no spotifyID skipped' % artist['name'])
+            continue
+        if artist_sp_id in inserted_sp_ids:
+            # another echonest artist in this batch maps to the same spotify artist
+            inserted_sp_ids[artist_sp_id].append(artist_id)
+            continue
+        inserted_sp_ids[artist_sp_id] = [artist_id]
+        insert_artists.append((artist, artist_sp_id))
+    new_artists = []
+    if len(insert_artists) == 0:
+        return db_artists, new_artists
+    db_insert_artists(insert_artists, genres_name)
+    db.session.commit()
+    # commit expired all loaded artists so load them again together with new ones
+    db_artists.update(db_get_artists_by_echonest_ids(echonest_ids))
+    for artist, artist_sp_id in insert_artists:
+        db_a = db_artists[artist['id']]
+        new_artists.append(db_a)
+        for artist_id in inserted_sp_ids[artist_sp_id]:
+            db_artists[artist_id] = db_a
+
+    return db_artists, new_artists
+
+
 def transfer_songs(track_mappings, genres_name, song_type=None, force_update=False, chunk_size=100):
     processed_songs = {}  # return all newly added or existing songs
     db_songs = []
@@ -297,7 +587,7 @@ def transfer_songs(track_mappings, genres_name, song_type=None, force_update=Fal
         spotify_ids = [m[0] for m in track_mappings]
         db_songs = db_get_songs_by_spotify_ids(spotify_ids)
         for db_s in db_songs:
-            processed_songs[normalized_song_dedup_name(db_s.ArtistId, db_s.Name)] = db_s
+            processed_songs[normalized_song_dedup_name(db_s.ArtistId, db_s.Name)] = db_s.EchonestId
         # remove spotify ids already in db
         indexed_songs = db_get_spotify_track_ids_for_songs([s.SongId for s in db_songs])
         check_mappings = [mapping for mapping in track_mappings if mapping[0] not in indexed_songs]
@@ -305,37 +595,28 @@ def transfer_songs(track_mappings, genres_name, song_type=None, force_update=Fal
         check_mappings = track_mappings[:]
 
     # get multiple tracks
-    for chunk in list_chunker(check_mappings, chunk_size):
-        songs = echonest_helper.get_songs([m[0] for m in chunk]) or {'songs': []}
+    # chunks are fetched concurrently while previous ones are written
+    chunks = list(list_chunker(check_mappings, chunk_size))
+    for chunk, songs in zip(chunks, echonest_helper.imap_concurrent(echonest_helper.get_songs,
+                                                                    [[m[0] for m in chunk] for chunk in chunks])):
+        songs = songs or {'songs': []}
+        known_spotify_ids = db_get_known_spotify_track_ids_for_songs(songs['songs'])
+        db_artists, chunk_new_artists = transfer_songs_artists(songs['songs'], chunk, genres_name)
+        new_artists.extend(chunk_new_artists)
+        upsert_songs = []
         for song in songs['songs']:
-            # check if artist exists
-            db_a = db_get_artist_by_echonest_id(song['artist_id'])
-            if db_a is None:
-                # get artist
-                artist = echonest_helper.get_artist(song['artist_id'])
-                # if artist has no foreign id try to get spotify artist id from mappings
-                additional_spotify_id = None
-                if 'foreign_ids' not in artist:
-                    song_foreign_ids = [t['foreign_id'] for t in song['tracks'] if 'foreign_id' in t]
-                    additional_spotify_id = get_first(chunk, lambda m: m[0] in song_foreign_ids)
-                    if additional_spotify_id is not None:
-                        additional_spotify_id = additional_spotify_id[1]
-                if additional_spotify_id is not None:
-                    # get db_a by spotify id
-                    db_a = db_get_artist_by_spotify_id(additional_spotify_id)
-                if db_a is None:
-                    db_a = db_update_artist(artist, genres_name, additional_spotify_id=additional_spotify_id)
-                    db.session.commit()
-                    new_artists.append(db_a)
+            db_a = db_artists.get(song['artist_id'])
             # write song
             if db_a is not None:
                 # todo: we may allow artists without spotify reference so we can process more songs
                 genre_id = db_a.Genres[0].GenreId if db_a.Genres is not None and len(db_a.Genres) > 0 else None
-                db_s = db_update_song(song, db_a.ArtistId, genre_id, song_type=song_type,
-                                      processed_songs=processed_songs)
-                if db_s is not None:  # duplicate songs and songs without spotify reference are skipped
-                    db_songs.append(db_s)
-                    db.session.commit()
+                upsert_songs.append((song, db_a.ArtistId, genre_id))
+        # duplicate songs and songs without spotify reference are skipped
+        echonest_ids = db_upsert_songs(upsert_songs, song_type, processed_songs=processed_songs,
+                                       known_spotify_ids=known_spotify_ids)
+        db.session.commit()
+        if len(echonest_ids) > 0:
+            db_songs.extend(db.session.query(Song).filter(Song.EchonestId.in_(echonest_ids)).all())
 
     newly_indexed_songs = db_get_song_ids_for_tracks_by_spotify_ids([m[0] for m in check_mappings])
     indexed_songs.update(newly_indexed_songs)
@@ -6,6 +6,10 @@ from functools import reduce
 from random import random
 from bisect import bisect
 from itertools import accumulate
+from glob import glob, escape as glob_escape
+from hashlib import md5
+from threading import get_ident
+import numpy as np
 
 from common.common import *
 from common import spotify_helper
@@ -16,6 +20,8 @@ from server import app, song_helper
 class UserLibrary:
     version = 1
     storage_extension = '.library'
+    features_storage_extension = '.library_features.npy'
+    genres_storage_extension = '.library_genres'
 
     def __init__(self, spotify_id):
         self.is_new = True
@@ -272,7 +278,7 @@ def resolve_user_library(library, genres_name):
     return indexed_songs, found_songs, not_found_songs, new_artists
 
 
-def get_best_playlist_id(playlist_type, library, possible_clusters, keep_n_last = 5):
+def get_best_playlist_id(playlist_type, library, possible_clusters, keep_n_last = 5, rng=None):
     # get N best possible clusters that are were not yet used, ps format
     # (pl_id, prevalence, genres_affinity[i], genres_pref[i])
     library_props = load_library_props(library.spotify_id)
@@ -287,7 +293,7 @@ def get_best_playlist_id(playlist_type, library, possible_clusters, keep_n_last
     tot_w = reduce(lambda x,y: x + y[3], non_sel_pl, 0)
     non_sel_pl_cumul = list(accumulate([pl[3]/tot_w for pl in non_sel_pl]))
     # non_sel_pl_cumul.append(1.00001)
-    mass = random()
+    mass = rng.random_sample() if rng is not None else random()
     pl_idx = bisect(non_sel_pl_cumul, mass)
     if pl_idx > len(non_sel_pl_cumul):
         pl_idx = len(non_sel_pl_cumul) - 1  # for the rare(impossible case we've got mass == 1)
@@ -319,4 +325,77 @@ def save_library(library):
 def delete_library(spotify_id):
     _delete_library(spotify_id, UserLibraryProps)
     _delete_library(spotify_id, UserLibrary)
+    for path in _library_features_paths(spotify_id) + [_library_genres_path(spotify_id)]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _tmp_path(path):
+    # request handlers and mq consumers may write the same file at once
+    return '%s.%i.%i.tmp' % (path, os.getpid(), get_ident())
+
+
+def _library_features_path(library, sn):
+    # features file is named after (resolved_at, global cache sn) so library record does not store the key
+    key = md5(repr((library.resolved_at, sn)).encode('utf-8')).hexdigest()
+    return app.config['USER_STORAGE_URI'] + library.spotify_id + '.' + key + UserLibrary.features_storage_extension
+
+
+def _library_features_paths(spotify_id):
+    return glob(glob_escape(app.config['USER_STORAGE_URI'] + spotify_id) + '.*' +
+                UserLibrary.features_storage_extension)
+
+
+def save_library_features(library, song_features, sn):
+    # scaled song features of resolved library, features of previous library or global cache are removed
+    path = _library_features_path(library, sn)
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'bw') as f:
+        np.save(f, song_features)
+    os.replace(tmp_path, path)
+    # previous files may be still mapped by running processes, unlink is safe
+    for prev_path in _library_features_paths(library.spotify_id):
+        if prev_path != path:
+            try:
+                os.remove(prev_path)
+            except FileNotFoundError:
+                pass
+
+
+def load_library_features(library, sn):
+    # memory mapped read only features if materialized for current library and global cache, None otherwise
+    path = _library_features_path(library, sn)
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+
+def _library_genres_path(spotify_id):
+    return app.config['USER_STORAGE_URI'] + spotify_id + UserLibrary.genres_storage_extension
+
+
+def save_library_genres(library, sn, library_genres):
+    # genres computed from materialized features, song indexes refer to rows of those features
+    path = _library_genres_path(library.spotify_id)
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'bw') as f:
+        pickle.dump({'key': (library.resolved_at, sn), 'genres': library_genres}, f, protocol=4)
+    os.replace(tmp_path, path)
+
+
+def load_library_genres(library, sn):
+    # genres if computed for current library and global cache, None otherwise
+    path = _library_genres_path(library.spotify_id)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'br') as f:
+            entry = pickle.load(f)
+    except (pickle.PickleError, TypeError, EOFError) as e:
+        # genres can be recomputed, corrupt or partially written file is discarded
+        app.logger.warning('library genres %s could not be loaded (%s), removed' % (path, e))
+        os.remove(path)
+        return None
+    return entry['genres'] if entry['key'] == (library.resolved_at, sn) else None
 
@@ -0,0 +1,73 @@
+import os, inspect
+import timeit
+import numpy as np
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+os.sys.path.insert(0, parentdir)
+
+from common.common import get_first
+from server import music_graph_helper as mgh
+
+
+def _trim_song_slice_length_by_acoustics_ref(track_mappings, song_features, desired_length, distance_features):
+    # previous O(n^2) implementation, kept to check ordering semantics
+    c_len = 0
+    mapped_song_features = []
+    mapped_song_adiffs = []
+    for track_id, song_id in track_mappings:
+        song = get_first(song_features, lambda s: s[mgh._f_song_id_i] == song_id)
+        c_len += song[mgh._f_duration_id_i]
+        mapped_song_features.append(song)
+    for idx in range(len(mapped_song_features)-2):
+        song = mapped_song_features[idx]
+        ref_song = mapped_song_features[idx+2]
+        mapped_song_adiffs.append(mgh._euclidean_dist(ref_song[distance_features], song[distance_features]))
+
+    while True:
+        rem_idx = min(range(len(mapped_song_adiffs)), key=mapped_song_adiffs.__getitem__) + 1
+        rem_len = mapped_song_features[rem_idx][mgh._f_duration_id_i]
+        if c_len - rem_len < desired_length:
+            break
+        c_len -= rem_len
+        del mapped_song_features[rem_idx]
+        del track_mappings[rem_idx]
+        if rem_idx < len(mapped_song_adiffs):
+            del mapped_song_adiffs[rem_idx]
+            song = mapped_song_features[rem_idx-1]
+            ref_song = mapped_song_features[rem_idx+1]
+            mapped_song_adiffs[rem_idx-1] = mgh._euclidean_dist(ref_song[distance_features], song[distance_features])
+        else:
+            del mapped_song_adiffs[rem_idx-1]
+
+    return [t[0] for t in track_mappings], int(c_len)
+
+
+def _random_songs(n_songs, seed):
+    rs = np.random.RandomState(seed)
+    song_features = rs.randn(n_songs, 21).astype(np.float32)
+    song_features[:, mgh._f_song_id_i] = rs.permutation(n_songs) + 1000
+    song_features[:, mgh._f_duration_id_i] = rs.randint(2*60*1000, 6*60*1000, n_songs)
+    track_mappings = [('spotify:track:%i' % song_id, int(song_id)) for song_id in song_features[:, mgh._f_song_id_i]]
+    return song_features, track_mappings
+
+
+def benchmark_trim_song_slice_length_by_acoustics(n_songs=500, repeat=5):
+    song_features, track_mappings = _random_songs(n_songs, 7)
+    songs = list(song_features)
+    # trim to half of the slice
+    desired_length = int(np.sum(song_features[:, mgh._f_duration_id_i]) / 2)
+    expected = _trim_song_slice_length_by_acoustics_ref(list(track_mappings), songs, desired_length,
+                                                        mgh._sound_energy_dist)
+    actual = mgh.trim_song_slice_length_by_acoustics(list(track_mappings), songs, desired_length,
+                                                     mgh._sound_energy_dist)
+    # durations are summed in float32 by previous implementation and differ for long slices
+    assert expected[0] == actual[0], 'trimmed tracks differ'
+    t_ref = min(timeit.repeat(lambda: _trim_song_slice_length_by_acoustics_ref(
+        list(track_mappings), songs, desired_length, mgh._sound_energy_dist), number=1, repeat=repeat))
+    t = min(timeit.repeat(lambda: mgh.trim_song_slice_length_by_acoustics(
+        list(track_mappings), songs, desired_length, mgh._sound_energy_dist), number=1, repeat=repeat))
+    print('trim_song_slice_length_by_acoustics %i songs: %.1f ms (was %.1f ms)' % (n_songs, t*1000, t_ref*1000))
+
+
+if __name__ == '__main__':
+    benchmark_trim_song_slice_length_by_acoustics()
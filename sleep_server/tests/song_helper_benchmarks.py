@@ -0,0 +1,85 @@
+import os, inspect
+import logging
+import tempfile
+import time
+from sqlalchemy import String
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+os.sys.path.insert(0, parentdir)
+
+from server import app, db
+# must be set before engine is created on first db access
+_db_file = os.path.join(tempfile.mkdtemp(), 'song_helper_benchmarks.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + _db_file
+# per song debug logging would dominate the timings
+app.logger.setLevel(logging.WARNING)
+
+from common.common import list_chunker
+from server.models import Song, SongTracks
+from server import song_helper
+
+
+def _pyen_songs(n_songs, n_artists, tracks_per_song=2):
+    songs = []
+    for i in range(n_songs):
+        songs.append({'id': 'SO%016i' % i, 'title': 'song %i' % i, 'artist_id': 'AR%016i' % (i % n_artists),
+                      'song_hotttnesss': 0.5,
+                      'audio_summary': {'duration': 180.5, 'key': 1, 'energy': 0.2, 'liveness': 0.1, 'tempo': 120.0,
+                                        'speechiness': 0.05, 'acousticness': 0.7, 'instrumentalness': 0.3,
+                                        'mode': 1, 'time_signature': 4, 'loudness': -10, 'valence': 0.4,
+                                        'danceability': 0.6},
+                      'tracks': [{'id': 'TR%016i%i' % (i, t), 'foreign_id': 'spotify:track:%016i%i' % (i, t)}
+                                 for t in range(tracks_per_song)]})
+    return songs
+
+
+def _strip_collations():
+    # mysql collations declared in models do not exist in sqlite
+    for table in db.metadata.tables.values():
+        for column in table.columns:
+            if isinstance(column.type, String):
+                column.type.collation = None
+
+
+def _reset_db():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+
+def _transfer_orm(songs, chunk_size):
+    # previous path: orm object per song and commit per song
+    processed_songs = {}
+    for song in songs:
+        db_s = song_helper.db_update_song(song, int(song['artist_id'][2:]) + 1, None, 0, processed_songs)
+        if db_s is not None:
+            db.session.commit()
+
+
+def _transfer_core(songs, chunk_size):
+    processed_songs = {}
+    for chunk in list_chunker(songs, chunk_size):
+        known_spotify_ids = song_helper.db_get_known_spotify_track_ids_for_songs(chunk)
+        song_helper.db_upsert_songs([(song, int(song['artist_id'][2:]) + 1, None) for song in chunk], 0,
+                                    processed_songs=processed_songs, known_spotify_ids=known_spotify_ids)
+        db.session.commit()
+
+
+def benchmark_transfer_songs(n_songs=2000, n_artists=200, chunk_size=100):
+    songs = _pyen_songs(n_songs, n_artists)
+    _strip_collations()
+    for name, f in [('orm', _transfer_orm), ('core upsert', _transfer_core)]:
+        _reset_db()
+        start = time.perf_counter()
+        f(songs, chunk_size)
+        elapsed = time.perf_counter() - start
+        songs_count = db.session.query(Song).count()
+        tracks_count = db.session.query(SongTracks).count()
+        assert songs_count == n_songs and tracks_count == n_songs * 2, 'songs not transferred'
+        print('transfer %i songs with %s: %.0f rows/s' % (n_songs, name, (songs_count + tracks_count) / elapsed))
+    db.session.remove()
+    os.remove(_db_file)
+
+
+if __name__ == '__main__':
+    benchmark_transfer_songs()